@@ -2,6 +2,7 @@
 using System.Collections.Generic;
 using System.Diagnostics;
 using System.Runtime.InteropServices;
+using System.Text;
 using System.Text.Json;
 using System.Text.RegularExpressions;
 using OpenAI.Chat;
@@ -197,7 +198,7 @@ namespace ChatPOC.Chatbot
             ProcessStartInfo start = new ProcessStartInfo
             {
                 FileName = "python",
-                Arguments = $"./query.py \"{query}\"",
+                Arguments = $"./query.py --passages \"{query}\"",
                 UseShellExecute = false,
                 RedirectStandardOutput = true,
                 RedirectStandardError = true,
@@ -228,17 +229,44 @@ namespace ChatPOC.Chatbot
             return paths;
         }
 
+        private static string ReadRange(string path, long start, long end)
+        {
+            // Passage ranges are byte offsets into the UTF-8 file
+            using (FileStream stream = File.OpenRead(path))
+            {
+                byte[] buffer = new byte[end - start];
+                stream.Seek(start, SeekOrigin.Begin);
+                int read = 0;
+                while (read < buffer.Length)
+                {
+                    int count = stream.Read(buffer, read, buffer.Length - read);
+                    if (count == 0)
+                    {
+                        break;
+                    }
+                    read += count;
+                }
+                return Encoding.UTF8.GetString(buffer, 0, read);
+            }
+        }
+
         private static string FetchContext(List<String> paths)
         {
             List<string> filesContents = new List<string>();
 
-            foreach (string path in paths)
+            foreach (string line in paths)
             {
+                // Passages come back as "path<TAB>start<TAB>end", whole documents as just the path
+                string[] parts = line.Split('\t');
+                string path = parts[0];
+
                 // Assume the returned path is relative if it isn't rooted.
 
                 if (File.Exists(path))
                 {
-                    string fileContents = File.ReadAllText(path);
+                    string fileContents = parts.Length == 3 && long.TryParse(parts[1], out long start) && long.TryParse(parts[2], out long end)
+                        ? ReadRange(path, start, end)
+                        : File.ReadAllText(path);
                     filesContents.Add(fileContents);
                     Debug.WriteLine($"File found: {path}");
                 } else
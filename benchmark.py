@@ -0,0 +1,293 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Runs the whole pipeline over a generated documentation site and reports throughput per stage.
+# The site is served from a local HTTP server and uploads go to an SQLite database in a scratch
+# directory, so no network, MySQL or existing downloads are touched.
+#
+#   python benchmark.py --docs 1000 --output results.json
+#   python benchmark.py --docs 1000 --baseline results.json
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+# Metric name -> whether higher values are better
+METRICS = {
+    "crawl_pages_per_sec":      True,
+    "preprocess_docs_per_sec":  True,
+    "train_words_per_sec":      True,
+    "vectorize_docs_per_sec":   True,
+    "upload_rows_per_sec":      True,
+    "index_load_ms":            False,
+    "query_p50_ms":             False,
+    "query_p95_ms":             False,
+    "query_p99_ms":             False,
+    "filtered_query_p50_ms":    False,
+}
+
+DOCS_PER_SECTION = 100
+SYLLABLES = ["ap", "pa", "ti", "ent", "clin", "ic", "in", "sur", "ance", "med", "ca", "tion", "pro", "ced",
+             "ure", "al", "ler", "gy", "ben", "e", "fit", "claim", "ap", "point", "ment", "re", "quest", "or"]
+API_WORDS = ["GET", "PUT", "POST", "DELETE", "PatNum", "ClinicNum", "AptNum", "Date", "string", "int",
+             "optional", "required", "returns", "example", "parameter", "response", "field", "resource"]
+
+
+class SyntheticSite:
+    # Deterministic documentation site: an index page linking to sections of DOCS_PER_SECTION pages
+    # each, so the crawler reaches every page at depth 2. Pages are generated on request.
+    def __init__(self, docs, seed=0):
+        self.docs = docs
+        self.sections = (docs + DOCS_PER_SECTION - 1) // DOCS_PER_SECTION
+        self.seed = seed
+        rng = random.Random(seed)
+        words = set()
+        while len(words) < 5000:
+            words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+        self.words = sorted(words) + API_WORDS
+        # Zipf-like word frequencies, like real prose
+        self.weights = [1 / (rank + 1) for rank in range(len(self.words))]
+        rng.shuffle(self.weights)
+
+    @property
+    def pages(self):
+        return self.docs + self.sections + 1
+
+    def sentence(self, rng, low, high):
+        return " ".join(rng.choices(self.words, self.weights, k=rng.randint(low, high)))
+
+    def page(self, name):
+        if name == "apispecification":
+            links = [f"section{section}.html" for section in range(self.sections)]
+            return self.render("API Specification", [], links)
+        if name.startswith("section") and name[7:].isdigit() and int(name[7:]) < self.sections:
+            first = int(name[7:]) * DOCS_PER_SECTION
+            links = [f"doc{doc}.html" for doc in range(first, min(first + DOCS_PER_SECTION, self.docs))]
+            return self.render(f"API Section {name[7:]}", [], links)
+        if name.startswith("doc") and name[3:].isdigit() and int(name[3:]) < self.docs:
+            rng = random.Random(self.seed * 1000003 + int(name[3:]))
+            paragraphs = [self.sentence(rng, 20, 60) + "." for _ in range(rng.randint(3, 8))]
+            items = [self.sentence(rng, 3, 10) for _ in range(rng.randint(2, 6))]
+            return self.render(f"API {self.sentence(rng, 1, 3)}", paragraphs, ["apispecification.html"], items)
+        return None
+
+    def render(self, title, paragraphs, links, items=()):
+        body = [f"<h1>{title}</h1>"]
+        body.extend(f"<p>{paragraph}</p>" for paragraph in paragraphs)
+        if items:
+            body.append("<ul>" + "".join(f"<li>{item}</li>" for item in items) + "</ul>")
+        body.append("<nav><a href=\"apispecification.html\">Open Dental Home</a></nav>")
+        body.extend(f"<p><a href=\"{link}\">{link}</a></p>" for link in links)
+        return f"<html><head><title>{title}</title></head><body>{''.join(body)}</body></html>"
+
+    def queries(self, count):
+        rng = random.Random(self.seed + 1)
+        return [self.sentence(rng, 3, 8) for _ in range(count)]
+
+
+def serve(site):
+    class SiteHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            name = self.path.split("?")[0].rsplit("/", 1)[-1].rsplit(".", 1)[0]
+            html = site.page(name) if self.path.startswith("/site/api/") else None
+            body = (html or "Not found").encode("utf-8")
+            self.send_response(200 if html else 404)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@contextlib.contextmanager
+def stage(name, log):
+    # Pipeline output goes to the log so stdout only carries the results
+    print(f"Running {name}...", file=sys.stderr)
+    with contextlib.redirect_stdout(log):
+        yield
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def run(args, work_dir):
+    # The pipeline modules read their config from the environment on import
+    os.environ.update({
+        "DOWNLOADS_PATH":        work_dir,
+        "MODEL_PATH":            os.path.join(work_dir, "benchmark.model"),
+        "STORAGE_BACKEND":       "sqlite",
+        "SQLITE_PATH":           os.path.join(work_dir, "documents.db"),
+        "INCREMENTAL":           "false",
+        "CRAWL_RATE_LIMIT":      "0",
+        "TRAIN_EPOCHS":          str(args.epochs),
+        "TRAIN_TIME_LIMIT":      "0",
+        "TRAIN_LOSS_TOLERANCE":  "0",
+        "INDEX_PATH":            os.path.join(work_dir, "index"),
+        # Nothing under work_dir is a shards.json, so a shards.json in WORKING_DIR can't take over the index
+        "SHARDS_PATH":           os.path.join(work_dir, "no-shards.json"),
+        "TOKEN_CACHE_PATH":      os.path.join(work_dir, "token_cache"),
+        "RESULT_CACHE_SIZE":     "0",
+    })
+
+    import crawler
+    import processor
+    import upload
+    import query_engine
+    from bundle import BundleWriter, document_record
+    from filters import build_filters
+
+    site = SyntheticSite(args.docs, args.seed)
+    server = serve(site)
+    metrics = {}
+    log = open(os.path.join(work_dir, "benchmark.log"), "w", encoding="utf-8")
+    try:
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/site/api/"
+        with stage("crawl", log):
+            start = time.perf_counter()
+            crawler.crawl(START_URL=base_url + "apispecification.html", MAX_DEPTH=2, WHITELIST=[base_url],
+                          DOWNLOADS_PATH=work_dir, RATE_LIMIT=0, INCREMENTAL=False)
+            metrics["crawl_pages_per_sec"] = site.pages / (time.perf_counter() - start)
+
+        csv_data = processor.read_csv(os.path.join(work_dir, "data.csv"))
+        with stage("preprocessing", log):
+            start = time.perf_counter()
+            corpus = processor.process_documents(processor.read_docs(csv_data))
+            metrics["preprocess_docs_per_sec"] = len(csv_data) / (time.perf_counter() - start)
+
+        with stage("training", log):
+            start = time.perf_counter()
+            model = processor.model_setup(corpus)
+            metrics["train_words_per_sec"] = model.corpus_total_words * args.epochs / (time.perf_counter() - start)
+
+        with stage("vectorization", log):
+            bundle = BundleWriter(processor.config["INDEX_PATH"])
+            matrix = bundle.open_vectors(len(csv_data), model.vector_size)
+            start = time.perf_counter()
+            for idx, vec in enumerate(processor.vectorize_documents(corpus, model)):
+                matrix[idx] = processor.normalize(vec)
+            metrics["vectorize_docs_per_sec"] = len(csv_data) / (time.perf_counter() - start)
+            processor.build_query_model(bundle, csv_data, model)
+            build_filters(bundle, [document_record(row) for row in csv_data])
+            bundle.commit(csv_data, model)
+            processor.save_csv(processor.append_vec(csv_data, matrix))
+
+        with stage("upload", log):
+            start = time.perf_counter()
+            upload.main()
+            metrics["upload_rows_per_sec"] = len(csv_data) / (time.perf_counter() - start)
+
+        with stage("queries", log):
+            start = time.perf_counter()
+            index = query_engine.load_index()
+            metrics["index_load_ms"] = (time.perf_counter() - start) * 1000
+            queries = site.queries(args.queries)
+            index.search(queries[0], 5)
+            latencies = []
+            for query_text in queries:
+                start = time.perf_counter()
+                index.search(query_text, 5)
+                latencies.append((time.perf_counter() - start) * 1000)
+            for q in (50, 95, 99):
+                metrics[f"query_p{q}_ms"] = percentile(latencies, q)
+
+            # doc1, doc10-19, doc100-199 and so on, about a tenth of the pages
+            filters = ["url_path^=/site/api/doc1"]
+            latencies = []
+            for query_text in queries:
+                start = time.perf_counter()
+                index.search(query_text, 5, filters=filters)
+                latencies.append((time.perf_counter() - start) * 1000)
+            metrics["filtered_query_p50_ms"] = percentile(latencies, 50)
+    finally:
+        server.shutdown()
+        log.close()
+
+    return {
+        "docs":     args.docs,
+        "pages":    site.pages,
+        "epochs":   args.epochs,
+        "queries":  args.queries,
+        "seed":     args.seed,
+        "python":   platform.python_version(),
+        "machine":  platform.machine(),
+        "cpus":     os.cpu_count(),
+        "metrics":  metrics,
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Prints every metric against the baseline, returns the names that got worse by more than tolerance
+    if any(results[key] != baseline.get(key) for key in ("docs", "epochs", "queries", "seed")):
+        print("Baseline was run with different settings, the comparison is only indicative", file=sys.stderr)
+
+    regressions = []
+    print(f"{'metric':26} {'baseline':>12} {'current':>12} {'change':>8}", file=sys.stderr)
+    for name, higher_is_better in METRICS.items():
+        current, previous = results["metrics"].get(name), baseline["metrics"].get(name)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        status = ""
+        if worse > tolerance:
+            regressions.append(name)
+            status = "REGRESSION"
+        print(f"{name:26} {previous:12.2f} {current:12.2f} {change:+8.1%} {status}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark crawl, preprocessing, training, vectorization, upload and queries")
+    parser.add_argument("--docs", type=int, default=1000, help="number of generated documentation pages")
+    parser.add_argument("--epochs", type=int, default=5, help="word2vec training epochs")
+    parser.add_argument("--queries", type=int, default=200, help="number of timed queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", metavar="FILE", help="also write the results JSON to FILE, e.g. to save a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against a saved results JSON, exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before a metric counts as a regression")
+    parser.add_argument("--work-dir", help="scratch directory to keep, a temporary one is used and removed otherwise")
+    args = parser.parse_args()
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run(args, os.path.abspath(args.work_dir))
+    else:
+        with tempfile.TemporaryDirectory(prefix="docchat-benchmark-") as work_dir:
+            results = run(args, work_dir)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import math
+import os
+import sys
+import numpy as np
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+from bm25 import BM25, build_bm25
+
+# Scores a three document corpus and compares against BM25 worked out by hand with k1 = 1.2, b = 0.75:
+#   idf(t)   = ln(1 + (N - n + 0.5) / (n + 0.5)), N = 3 documents, n = documents containing t
+#   score    = sum of idf(t) * f * (k1 + 1) / (f + k1 * (1 - b + b * length / 3)), 3 being the average length
+CORPUS = [
+    ["api", "clinic", "clinic"],
+    ["api", "patient"],
+    ["patient", "allergy", "allergy", "allergy"],
+]
+RARE = math.log(1 + 2.5 / 1.5)   # clinic, allergy: in one document
+COMMON = math.log(1 + 1.5 / 2.5)  # api, patient: in two
+CASES = [
+    # d0: clinic twice and api once at the average length, d1: api once in a 2 token document
+    (["clinic", "api"], None, [0, 1], [RARE * 2 * 2.2 / (2 + 1.2) + COMMON * 2.2 / (1 + 1.2), COMMON * 2.2 / (1 + 0.9)]),
+    # d2: allergy three times and patient once in a 4 token document, unknown terms add nothing
+    (["allergy", "patient", "missing"], None, [2, 1], [RARE * 3 * 2.2 / (3 + 1.5) + COMMON * 2.2 / (1 + 1.5), COMMON * 2.2 / (1 + 0.9)]),
+    # Repeated query terms count once
+    (["api", "api"], None, [1, 0], [COMMON * 2.2 / (1 + 0.9), COMMON * 2.2 / (1 + 1.2)]),
+    # Only the given rows are scored, a row no term occurs in is never returned
+    (["allergy", "patient"], np.array([0, 1]), [1], [COMMON * 2.2 / (1 + 0.9)]),
+    (["missing"], None, [], []),
+]
+
+
+def main():
+    failures = 0
+    index = BM25(build_bm25(CORPUS))
+    for tokens, rows, expected_ids, expected_scores in CASES:
+        ids, scores = index.search(tokens, 5, rows)
+        if list(ids) != expected_ids or not np.allclose(scores, expected_scores, rtol=1e-5):
+            failures += 1
+            print(f"{tokens} scored {list(ids)} {list(scores)}, expected {expected_ids} {expected_scores}")
+
+    # k cuts the ranking without reordering it
+    ids, _ = index.search(["allergy", "patient"], 1)
+    if list(ids) != [2]:
+        failures += 1
+        print(f"Top 1 for allergy patient is {list(ids)}, expected [2]")
+
+    print(f"{failures} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+# Crawls a small local site and checks that relative links on directory pages ("docs/guide/")
+# resolve inside the directory, also when the page was reached through a redirect from "docs/guide",
+# that a crawl interrupted after a few checkpoints resumes to the same pages, and that error
+# responses are never saved as pages, an incremental crawl keeps what it had for them
+TOPICS = 30
+FAILING = set()
+PAGES = {
+    "/docs/guide/":           '<html><body><h1>Guide</h1><p><a href="intro.html">Intro</a></p>'
+                              '<p><a href="../faq.html">FAQ</a></p>'
+                              + "".join(f'<p><a href="topic{i}.html">Topic {i}</a></p>' for i in range(TOPICS))
+                              + '<p><a href="missing.html">Missing</a></p>'
+                              + "</body></html>",
+    "/docs/guide/intro.html": "<html><body><h1>Intro</h1><p>Getting started.</p></body></html>",
+    "/docs/faq.html":         '<html><body><h1>FAQ</h1><p><a href="guide">Guide</a></p></body></html>',
+    **{f"/docs/guide/topic{i}.html": f"<html><body><h1>Topic {i}</h1><p>Details of topic {i}.</p></body></html>"
+       for i in range(TOPICS)},
+}
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/docs/guide":
+            self.send_response(301)
+            self.send_header("Location", "/docs/guide/")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = PAGES.get(self.path, "Not found").encode("utf-8")
+        self.send_response(503 if self.path in FAILING else 200 if self.path in PAGES else 404)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix="docchat-crawler-test-") as downloads:
+        os.environ["DOWNLOADS_PATH"] = downloads
+        import crawler
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        site = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            # The page itself, and the same page reached from "docs/guide" after the redirect
+            for url, base in ((f"{site}/docs/guide/", None), (f"{site}/docs/guide", f"{site}/docs/guide/")):
+                _, _, _, links = crawler.clean_and_save(url, PAGES["/docs/guide/"], downloads, base)
+                expected = [f"{site}/docs/guide/intro.html", f"{site}/docs/faq.html"]
+                if links[:2] != expected:
+                    failures += 1
+                    print(f"Links of {url} resolved to {links[:2]}, expected {expected}")
+
+            # Interrupt the crawl after a dozen fetches, with a checkpoint after every page
+            crawler.config["CHECKPOINT_EVERY"] = 1
+            fetch = crawler.fetch
+            calls = []
+
+            def interrupted_fetch(*args, **kwargs):
+                calls.append(args[1])
+                if len(calls) > 12:
+                    raise KeyboardInterrupt
+                return fetch(*args, **kwargs)
+
+            def crawl(incremental=False):
+                crawler.crawl(START_URL=f"{site}/docs/guide/", MAX_DEPTH=2, WHITELIST=[f"{site}/docs/"],
+                              DOWNLOADS_PATH=downloads, CONCURRENCY=1, RATE_LIMIT=0, INCREMENTAL=incremental)
+
+            crawler.fetch = interrupted_fetch
+            try:
+                crawl()
+            except KeyboardInterrupt:
+                pass
+            crawler.fetch = fetch
+            checkpoint_path = os.path.join(downloads, "crawl_state.jsonl")
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                records = f.read().splitlines()
+            if len(records) < 3:
+                failures += 1
+                print(f"Interrupted crawl left {len(records)} checkpoint records, expected a few")
+
+            crawl()
+            crawled = sorted(row[3] for row in crawler.read_csv_index(downloads))
+            # faq.html is outside the start page's directory, the crawl never leaves it
+            expected = sorted(site + path for path in PAGES if path != "/docs/faq.html")
+            if crawled != expected:
+                failures += 1
+                print(f"Crawled {crawled}, expected {expected}")
+            if os.path.exists(checkpoint_path):
+                failures += 1
+                print("The checkpoint was left behind after the crawl completed")
+
+            # A page failing with a 503 after the retries keeps last crawl's file and row
+            crawler.config["RETRIES"] = 0
+            FAILING.add("/docs/guide/topic0.html")
+            before = {row[3]: row for row in crawler.read_csv_index(downloads)}
+            crawl(incremental=True)
+            after = {row[3]: row for row in crawler.read_csv_index(downloads)}
+            if after != before:
+                failures += 1
+                print(f"Incremental crawl with a failing page changed data.csv from {before} to {after}")
+        finally:
+            server.shutdown()
+
+    print(f"{failures} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import random
+import sys
+import numpy as np
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+from dedup import MinHasher, find_duplicates, shingles
+
+# Groups a generated corpus of distinct pages, exact and near copies of them (a word or two edited)
+# and loose rewrites (half the words replaced), and checks the groups against the true Jaccard
+# similarity of every pair and against grouping every pair of signatures by brute force: copies
+# join their original, lowest index first, rewrites stay alone
+PAGES = 40
+WORDS = 1000
+THRESHOLD = 0.9
+
+
+def edit(rng, words, count):
+    words = list(words)
+    for idx in rng.sample(range(len(words)), count):
+        words[idx] = f"edit{rng.randrange(10**6)}"
+    return words
+
+
+def jaccard(first, second):
+    return len(first & second) / len(first | second)
+
+
+def main():
+    failures = 0
+    rng = random.Random(0)
+    vocabulary = [f"word{idx}" for idx in range(5000)]
+
+    texts = []
+    originals = {}
+    for page in range(PAGES):
+        words = rng.choices(vocabulary, k=WORDS)
+        originals[len(texts)] = words
+        texts.append(" ".join(words))
+    # Copies go after the originals in shuffled order, so a group's first member is its original
+    copies = [(page, 0) for page in range(0, PAGES, 4)] + [(page, 1) for page in range(1, PAGES, 4)] \
+             + [(page, 2) for page in range(2, PAGES, 8)] + [(page, WORDS // 2) for page in range(3, PAGES, 4)]
+    rng.shuffle(copies)
+    expected = {}
+    for page, count in copies:
+        if count < WORDS // 2:
+            expected.setdefault(page, [page]).append(len(texts))
+        texts.append(" ".join(edit(rng, originals[page], count)))
+
+    hasher = MinHasher()
+    signatures = np.array([hasher.signature(text) for text in texts])
+    groups = find_duplicates(signatures, THRESHOLD)
+    expected = [expected[page] for page in sorted(expected)]
+    if groups != expected:
+        failures += 1
+        print(f"Grouped {groups}, expected {expected}")
+
+    # The LSH bands find the same groups as comparing every pair of signatures
+    roots = list(range(len(texts)))
+    for first in range(len(texts)):
+        for second in range(first + 1, len(texts)):
+            if np.mean(signatures[first] == signatures[second]) >= THRESHOLD:
+                # Relabel the later group with the earlier one's lowest index
+                old, new = max(roots[first], roots[second]), min(roots[first], roots[second])
+                roots = [new if root == old else root for root in roots]
+    brute_force = {}
+    for idx, root in enumerate(roots):
+        brute_force.setdefault(root, []).append(idx)
+    brute_force = [members for members in brute_force.values() if len(members) > 1]
+    if groups != brute_force:
+        failures += 1
+        print(f"Grouped {groups}, comparing every pair of signatures groups {brute_force}")
+
+    # The expected groups are what the true similarity says, copies clear the threshold, rewrites don't
+    grouped = {idx: members[0] for members in expected for idx in members}
+    sets = [set(shingles(text).tolist()) for text in texts]
+    for first in range(len(texts)):
+        for second in range(first + 1, len(texts)):
+            similarity = jaccard(sets[first], sets[second])
+            together = grouped.get(first, first) == grouped.get(second, second)
+            if together != (similarity >= THRESHOLD):
+                failures += 1
+                print(f"Documents {first} and {second} have Jaccard similarity {similarity:.3f}, "
+                      f"{'grouped' if together else 'not grouped'} at threshold {THRESHOLD}")
+
+    # An empty corpus and a corpus without duplicates have no groups
+    if find_duplicates(np.empty((0, signatures.shape[1]), dtype=np.uint32), THRESHOLD) != []:
+        failures += 1
+        print("An empty corpus has duplicate groups")
+    if find_duplicates(signatures[:PAGES], THRESHOLD) != []:
+        failures += 1
+        print("Distinct pages were grouped")
+
+    print(f"{failures} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
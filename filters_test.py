@@ -0,0 +1,87 @@
+import os
+import random
+import sys
+import tempfile
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+from bundle import BundleWriter
+from filters import FIELDS, build_filters, field_value, load_filters, parse_filters
+
+# Resolves exact and prefix predicates, alone and combined, against generated documents and checks
+# the rows against filtering every document by brute force, for filter arrays read from a bundle
+# and for the fallback that sorts the manifest documents of older bundles
+DOCS = 500
+PREDICATES = 400
+SECTIONS = ["api", "api-v2", "apiary", "guide", "guide/setup", "café", "ñandú", ""]
+
+
+def generate(rng):
+    documents = []
+    for idx in range(DOCS):
+        section = rng.choice(SECTIONS)
+        name = rng.choice(["index", "intro", "Intro", f"page{rng.randrange(50)}", ""])
+        path = f"/site/{section}/{name}.html" if section else f"/site/{name}.html"
+        documents.append({
+            "file_name": f"{name}{idx}",
+            "page_name": rng.choice([name.title(), "Overview", "Übersicht", ""]),
+            "file_path": f"downloads/{name}{idx}",
+            "url":       f"http://127.0.0.1{path}",
+        })
+    return documents
+
+
+def random_predicate(rng, documents):
+    field = rng.choice(FIELDS)
+    value = field_value(rng.choice(documents), field)
+    if rng.random() < 0.5:
+        return f"{field}^={value[:rng.randint(0, len(value))]}"
+    # An exact value most of the time, sometimes one no document has
+    return f"{field}={value if rng.random() < 0.8 else value + 'x'}"
+
+
+def brute_force(documents, filters):
+    return [idx for idx, document in enumerate(documents)
+            if all(field_value(document, field) == value if op == "=" else field_value(document, field).startswith(value)
+                   for field, op, value in filters)]
+
+
+def main():
+    failures = 0
+    rng = random.Random(0)
+    documents = generate(rng)
+    with tempfile.TemporaryDirectory(prefix="docchat-filters-test-") as index_path:
+        bundle = BundleWriter(index_path)
+        build_filters(bundle, documents)
+        indexes = {
+            "bundle arrays": load_filters(index_path, {"files": bundle.files, "documents": documents}),
+            "manifest":      load_filters(index_path, {"files": {}, "documents": documents}),
+        }
+
+        for _ in range(PREDICATES):
+            predicates = [random_predicate(rng, documents) for _ in range(rng.choice([1, 1, 2, 3]))]
+            filters = parse_filters(predicates)
+            expected = brute_force(documents, filters)
+            for source, index in indexes.items():
+                # The second resolve comes from the cache
+                for rows in (index.resolve(filters), index.resolve(filters)):
+                    if [int(row) for row in rows] != expected:
+                        failures += 1
+                        print(f"{predicates} resolved to {len(rows)} rows from the {source}, expected {len(expected)}")
+
+    for predicate in ("title=API", "url", "url~=api"):
+        try:
+            parse_filters([predicate])
+            failures += 1
+            print(f"Invalid filter {predicate!r} was accepted")
+        except ValueError:
+            pass
+
+    print(f"{failures} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+from passages import read_blocks, split_passages
+
+# Splits generated documents, plain lines, list items and oversized lines with LF and CRLF endings,
+# and checks that the passages cover every non-blank byte, start and end on line boundaries, stay
+# within the size unless they are a single oversized line or item, and overlap by at most the overlap
+WORDS = ["patient", "allergy", "appointment", "clinic", "insurance", "GET", "PUT", "/api/v1/clinics", "200", "id"]
+DOCS = 300
+
+
+def generate(rng):
+    lines = []
+    for _ in range(rng.randint(0, 40)):
+        kind = rng.random()
+        if kind < 0.2:
+            # A list, the marker on its own line followed by the item text, as clean_and_save writes it
+            for number in range(rng.randint(1, 8)):
+                lines.append("-" if rng.random() < 0.5 else f"{number + 1}.")
+                lines.append(" ".join(rng.choices(WORDS, k=rng.randint(1, 15))))
+        elif kind < 0.25:
+            lines.append("")
+        else:
+            lines.append(" ".join(rng.choices(WORDS, k=rng.randint(1, 60 if kind > 0.95 else 12))))
+    newline = "\r\n" if rng.random() < 0.3 else "\n"
+    return newline.join(lines).encode("utf-8")
+
+
+def check(raw, size, overlap):
+    failures = []
+    passages = split_passages(raw, size, overlap)
+    units = {unit for block in read_blocks(raw) for unit in block}
+
+    covered = bytearray(len(raw))
+    for start, end in passages:
+        covered[start:end] = b"\1" * (end - start)
+        if start and raw[start - 1:start] != b"\n":
+            failures.append(f"passage {start}-{end} starts mid-line")
+        if end < len(raw) and raw[end:end + 1] not in (b"\n", b"\r"):
+            failures.append(f"passage {start}-{end} ends mid-line")
+        if end - start > size and (start, end) not in units:
+            failures.append(f"passage {start}-{end} is {end - start} bytes, over {size} and not a single unit")
+    for idx, byte in enumerate(raw):
+        if not covered[idx] and not chr(byte).isspace():
+            failures.append(f"byte {idx} is in no passage")
+            break
+
+    for (start, end), (next_start, next_end) in zip(passages, passages[1:]):
+        if next_start <= start or next_end <= end:
+            failures.append(f"passage {next_start}-{next_end} doesn't move past {start}-{end}")
+        if end - next_start > overlap:
+            failures.append(f"passages {start}-{end} and {next_start}-{next_end} overlap by {end - next_start} bytes, over {overlap}")
+    return failures
+
+
+def main():
+    failures = 0
+    rng = random.Random(0)
+    for doc in range(DOCS):
+        raw = generate(rng)
+        size = rng.choice([40, 120, 400])
+        overlap = rng.choice([0, size // 4, size // 2])
+        for failure in check(raw, size, overlap):
+            failures += 1
+            print(f"Document {doc} (size {size}, overlap {overlap}): {failure}")
+
+    print(f"{failures} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
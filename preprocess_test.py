@@ -0,0 +1,48 @@
+import sys
+import query_engine
+from bundle import read_manifest
+from preprocess import WORD, get_preprocessor, process_text
+from query_model import load_query_model
+import stemmer
+
+# Checks that the fast query path tokenizes exactly like process_text: the test queries plus
+# every line of every indexed document go through both, and every corpus word through both stemmers
+test_queries = [
+    "How do I do a PUT update for clinics?",
+    "How do I insert a new allergy?",
+    "How does a GET request for medications look like for a patient?",
+    "How do I view someone's insurance benefits?",
+    "How do I change a patient's appointment with the API to June 6th, 2025, at 3 PM?"
+]
+
+manifest = read_manifest(query_engine.config["INDEX_PATH"])
+query_model = load_query_model(query_engine.config["INDEX_PATH"], manifest)
+if query_model is None:
+    print("Index bundle has no query model, rebuild it with setup/processor.py")
+    sys.exit(1)
+_, fast = query_model
+
+texts = list(test_queries)
+for document in manifest["documents"]:
+    with open(document["file_path"], "r", encoding="utf-8") as file:
+        texts.extend(line for line in file.read().splitlines() if line.strip())
+
+mismatches = 0
+for text in texts:
+    expected = process_text(text)
+    actual = fast.process(text)
+    if actual != expected:
+        mismatches += 1
+        print(f"Token mismatch for {text!r}:\n  process_text: {expected}\n  fast path:    {actual}")
+
+words = set()
+for text in texts:
+    words.update(WORD.findall(text.lower()))
+porter = get_preprocessor().stemmer
+for word in sorted(words):
+    if stemmer.stem(word) != porter.stem(word):
+        mismatches += 1
+        print(f"Stem mismatch for {word!r}: {porter.stem(word)} != {stemmer.stem(word)}")
+
+print(f"{len(texts)} texts, {len(texts) - fast.fallbacks} on the fast path, {len(words)} words, {mismatches} mismatches")
+sys.exit(1 if mismatches else 0)
@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+import tempfile
+import numpy as np
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+# Runs a full and then an incremental processor build over a small generated corpus and checks that
+# every stored document vector, changed or not, matches the updated model
+DOCS = 40
+WORDS = ["patient", "allergy", "appointment", "clinic", "insurance", "benefit", "procedure", "claim",
+         "medication", "provider", "schedule", "payment", "referral", "insert", "update", "delete"]
+
+
+def write_docs(downloads, rng, changed=()):
+    rows = []
+    for i in range(DOCS):
+        path = os.path.join(downloads, f"doc{i}")
+        if not os.path.exists(path) or i in changed:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(" ".join(rng.choices(WORDS, k=12)) for _ in range(5)))
+        rows.append(f"doc{i},Doc {i},{path},http://127.0.0.1/site/api/doc{i}.html,{i}")
+    with open(os.path.join(downloads, "data.csv"), "w", encoding="utf-8") as f:
+        f.write("\n".join(rows) + "\n")
+
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix="docchat-processor-test-") as downloads:
+        os.environ.update({
+            "DOWNLOADS_PATH":     downloads,
+            "MODEL_PATH":         os.path.join(downloads, "word2vec.model"),
+            "INDEX_PATH":         os.path.join(downloads, "index"),
+            "TOKEN_CACHE_PATH":   os.path.join(downloads, "token_cache"),
+            "TRAIN_EPOCHS":       "20",
+            "PREPROCESS_WORKERS": "1",
+        })
+        import processor
+        from bundle import load_bundle
+        from changes import save_changes
+        from gensim.models import Word2Vec
+
+        rng = random.Random(0)
+        write_docs(downloads, rng)
+        processor.config["INCREMENTAL"] = False
+        processor.process()
+        _, before = load_bundle(processor.config["INDEX_PATH"])
+        before = np.array(before)
+
+        # One changed document retrains the shared word vectors
+        write_docs(downloads, rng, changed=(3,))
+        save_changes(downloads, {"added": [], "changed": ["doc3"], "removed": []})
+        processor.config["INCREMENTAL"] = True
+        processor.process()
+
+        _, matrix = load_bundle(processor.config["INDEX_PATH"])
+        model = Word2Vec.load(processor.config["MODEL_PATH"])
+        csv_data = processor.read_csv(os.path.join(downloads, "data.csv"))
+        corpus = processor.process_documents(processor.read_docs(csv_data))
+        for idx, vec in enumerate(processor.vectorize_documents(corpus, model)):
+            if not np.allclose(matrix[idx], processor.normalize(vec), atol=1e-5):
+                failures += 1
+                print(f"{csv_data[idx][0]} is stored with a vector from before the model update")
+
+        # The model did move, otherwise the check above proves nothing
+        if np.allclose(matrix[np.arange(DOCS) != 3], before[np.arange(DOCS) != 3], atol=1e-5):
+            failures += 1
+            print("Incremental training left every unchanged document vector where it was")
+
+    print(f"{failures} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,184 @@
-import sys
-import numpy as np
-import mysql.connector
-import re
+import argparse
+import json
 import os
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem.porter import PorterStemmer
-from gensim.models import Word2Vec
-from gensim.similarities import MatrixSimilarity
+import socket
+import sys
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
 from dotenv import load_dotenv
+from query_results import result_json, result_tuple
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+import metrics
 
 load_dotenv()
 
 config = {
-    "DOWNLOADS_PATH": os.getenv("DOWNLOADS_PATH"),
-    "MODEL_PATH":     os.getenv("MODEL_PATH"),
-    "WORKING_DIR":    os.getenv("WORKING_DIR"),
-    
-    "HOST":           os.getenv("MYSQL_HOST"),
-    "PORT":           os.getenv("MYSQL_PORT"),
-    "USER":           os.getenv("MYSQL_USER"),
-    "PASSWORD":       os.getenv("MYSQL_PASSWORD"),
-    "DATABASE":       os.getenv("MYSQL_DATABASE"),
+    "QUERY_SERVER_HOST": os.getenv("QUERY_SERVER_HOST", "127.0.0.1"),
+    "QUERY_SERVER_PORT": os.getenv("QUERY_SERVER_PORT", "8765"),
+    "TOP_K":             5,
 }
 
-if len(sys.argv) < 2:
-    print("Usage: python query.py \"<query>\"")
-    sys.exit(1)
 
-query_text = sys.argv[1]
+def server_url(endpoint):
+    return f"http://{config['QUERY_SERVER_HOST']}:{config['QUERY_SERVER_PORT']}{endpoint}"
+
 
-# Preprocess the query text
-stop_words = set(stopwords.words('english'))
-stemmer = PorterStemmer()
-tokens = word_tokenize(query_text)
-lowered = [t.lower() for t in tokens]
-stopped = [t for t in lowered if t not in stop_words]
-stemmed = [stemmer.stem(t) for t in stopped]    
-nummed = ['num' if t.isdigit() else t for t in stemmed]
-query_text = [t for t in nummed if re.match(r'[^\W\d]*$', t)]
+def request_server(request, timeout):
+    # Decoded JSON body from the resident query server, None when no server is listening.
+    # A server that answers with an error or doesn't answer in time raises, there's no point in
+    # loading the whole index here just to fail the same way or to wait even longer.
+    try:
+        with metrics.timer("query.server"), urlopen(request, timeout=timeout) as response:
+            body = response.read()
+    except HTTPError as e:
+        try:
+            message = json.loads(e.read().decode("utf-8"))["error"]
+        except (ValueError, KeyError, TypeError):
+            message = f"Query server answered HTTP {e.code}"
+        raise ValueError(message)
+    except URLError as e:
+        if isinstance(e.reason, socket.timeout):
+            raise ValueError(f"Query server didn't answer within {timeout}s")
+        return None
+    except socket.timeout:
+        raise ValueError(f"Query server didn't answer within {timeout}s")
+    except OSError:
+        return None
 
-model = Word2Vec.load(config["MODEL_PATH"])
+    try:
+        return json.loads(body.decode("utf-8"))
+    except ValueError:
+        # Something else is listening on the port
+        return None
+
+
+def query_server(query_text, k, passages=False, mode=None, shards=None, filters=None):
+    # Ask the resident query server, returns None if it isn't running
+    params = {"q": query_text, "k": k, "passages": int(passages)}
+    if mode:
+        params["mode"] = mode
+    if shards:
+        params["shards"] = ",".join(shards)
+    if filters:
+        params["filter"] = filters
+    body = request_server(server_url("/query?") + urlencode(params, doseq=True), 5)
+    if body is None:
+        return None
+    return [result_tuple(result) for result in body["results"]]
+
+
+def query_server_batch(query_texts, k, passages=False, mode=None, shards=None, filters=None):
+    payload = json.dumps({"queries": query_texts, "k": k, "passages": passages, "mode": mode, "shards": shards,
+                          "filters": filters}).encode("utf-8")
+    request = Request(server_url("/batch"), data=payload, headers={"Content-Type": "application/json"})
+    body = request_server(request, 60)
+    if body is None:
+        return None
+    return [[result_tuple(result) for result in results] for results in body["results"]]
+
+
+def query_local(query_text, k, passages=False, mode=None, shards=None, filters=None):
+    return query_local_batch([query_text], k, passages, mode, shards, filters)[0]
+
+
+def query_local_batch(query_texts, k, passages=False, mode=None, shards=None, filters=None):
+    # Fall back to loading everything in this process
+    with metrics.timer("query.load_index"):
+        import query_engine
+        index = query_engine.load_index()
+    return index.search_batch(query_texts, k, passages, mode, shards, filters)
+
+
+def read_batch(source, jsonl):
+    # One query per line, or JSONL records with a "query" field (and an optional "id" echoed back)
+    f = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
+    try:
+        records = []
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            records.append(json.loads(line) if jsonl else {"query": line})
+        return records
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def run_batch(source, jsonl, k, passages=False, mode=None, shards=None, filters=None):
+    records = read_batch(source, jsonl)
+    query_texts = [record["query"] for record in records]
+
+    results = query_server_batch(query_texts, k, passages, mode, shards, filters)
+    if results is None:
+        results = query_local_batch(query_texts, k, passages, mode, shards, filters)
+
+    for record, result in zip(records, results):
+        output = {"query": record["query"], "results": [result_json(item) for item in result]}
+        if "id" in record:
+            output = {"id": record["id"], **output}
+        print(json.dumps(output))
+
+
+def run_query(args):
+    if args.batch:
+        run_batch(args.batch, args.jsonl, args.top_k, args.passages, args.mode, args.shards, args.filter)
+        return
+
+    if args.query is None:
+        print("Usage: python query.py \"<query>\"")
+        sys.exit(1)
+
+    results = query_server(args.query, args.top_k, args.passages, args.mode, args.shards, args.filter)
+    if results is None:
+        results = query_local(args.query, args.top_k, args.passages, args.mode, args.shards, args.filter)
+
+    if not results:
+        print("No matching documents found." if args.filter else "No known words found in query.")
+        sys.exit(1)
+
+    for result in results:
+        # Passages print as "path<TAB>start<TAB>end" byte ranges, whole documents as just the path
+        if len(result) == 4 and result[2] is not None:
+            print(f"{result[0]}\t{result[2]}\t{result[3]}")
+        else:
+            print(result[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="python query.py \"<query>\"\n       python query.py --batch <file|-> [--jsonl]")
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--batch", metavar="FILE", help="read queries from FILE, or stdin with -, and print JSONL results")
+    parser.add_argument("--jsonl", action="store_true", help="batch input is JSONL with a \"query\" field per record")
+    parser.add_argument("-k", "--top-k", type=int, default=config["TOP_K"])
+    parser.add_argument("--passages", action="store_true", help="return the best passages as byte ranges instead of whole documents")
+    parser.add_argument("--mode", choices=("dense", "bm25", "hybrid", "prefilter"),
+                        help="ranking mode, defaults to SEARCH_MODE (dense)")
+    parser.add_argument("--shards", type=lambda value: [name for name in value.split(",") if name],
+                        help="comma separated shards to search, defaults to every shard in shards.json")
+    parser.add_argument("--filter", action="append", metavar="FIELD=VALUE",
+                        help="only search documents whose url, url_path, page_name or file_name equals VALUE, "
+                             "or starts with it for FIELD^=VALUE, repeat to combine")
+    parser.add_argument("--metrics", choices=metrics.FORMATS, help="record stage timings, overrides METRICS")
+    parser.add_argument("--profile", metavar="FILE", help="dump a cProfile of the query to FILE")
+    args = parser.parse_args()
+    if args.top_k < 1:
+        parser.error("-k must be a positive integer")
+    metrics.configure(args.metrics)
 
-# Vectorize the query by words
-word_vecs = []
-for word in query_text:
     try:
-        vec = model.wv[word]
-        word_vecs.append(vec)
-    except KeyError:
-        pass
-
-if not word_vecs:
-    print("No known words found in query.")
-    sys.exit(1)
-
-# Calculate the mean vector for the query
-query_vec = np.mean(word_vecs, axis=0)
-
-# Connect to the MySQL database
-connection = mysql.connector.connect(
-    host=config["HOST"],
-    port=config["PORT"],
-    user=config["USER"],
-    password=config["PASSWORD"],
-    database=config["DATABASE"],
-)
-cursor = connection.cursor()
-
-# Query for file_path and vector_representation
-sql = "SELECT file_path, vector_representation FROM webpages"
-cursor.execute(sql)
-results = cursor.fetchall()
-
-def parse_vector(vector_str):
-    # Remove the surrounding brackets
-    vector_str = vector_str.strip()[1:-1]
-    
-    # Split the string using semicolons as delimiters
-    elements = vector_str.split(';')
-    vector = []
-    for elem in elements:
-        elem = elem.strip()
-        if elem:
-            # Ideally float not stored as string, but on time crunch we'll live with it
-            try:
-                vector.append(float(elem))
-            except ValueError:
-                print(f"Skipping non-numeric value: {elem}")
-                pass
-    return vector
-
-docs = []
-paths = []
-for file_path, vector_str in results:
-    vector = parse_vector(vector_str)
-    docs.append(vector)
-    paths.append(file_path)
-
-docs = [list(enumerate(doc)) for doc in docs]
-index = MatrixSimilarity(docs, num_features=model.vector_size)
-
-# Compute the similarity scores between the query and all documents, get top 3
-similarity_scores = index[query_vec]
-top5_ids = np.array(similarity_scores).argsort()[-5:][::-1]
-top5_paths = [paths[idx] for idx in top5_ids]
-
-# print("Top 3 matching document paths:")
-for path in top5_paths:
-    print(path)
-
-cursor.close()
-connection.close()
\ No newline at end of file
+        with metrics.profile(args.profile), metrics.timer("query.total"):
+            run_query(args)
+    except ValueError as e:
+        # Unknown shards, invalid filters and the like, or errors from the query server
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
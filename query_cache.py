@@ -0,0 +1,46 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    # LRU cache of search results with a time to live. Keys are built from the preprocessed query
+    # tokens and the index version, so a reloaded index never serves results from the old one.
+    def __init__(self, max_size=1024, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (not self.ttl or time.monotonic() - entry[0] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits":     self.hits,
+                "misses":   self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size":     len(self.entries),
+                "max_size": self.max_size,
+                "ttl":      self.ttl,
+            }
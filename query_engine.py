@@ -0,0 +1,420 @@
+import heapq
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+from query_cache import ResultCache
+
+setup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup')
+if setup_dir not in sys.path:
+    sys.path.insert(0, setup_dir)
+
+from vectors import decode_matrix, parse_legacy_vector
+from bundle import bundle_exists, load_array, load_bundle, model_fingerprint, read_manifest
+from ann import CENTROIDS, IDS, OFFSETS, search_ivf
+from passages import PASSAGE_DOCS, PASSAGE_RANGES, PASSAGES, passage_rows, select_passages
+from bm25 import BM25, NAMES as BM25_NAMES, fuse_ranks
+from quantize import F16, I8, SCALE, search_compact
+from preprocess import process_text
+import metrics
+from query_model import load_query_model
+from filters import load_filters, parse_filters
+from storage import open_storage
+from shards import load_shards, select_shards, shard_index_path
+
+load_dotenv()
+
+config = {
+    "DOWNLOADS_PATH":    os.getenv("DOWNLOADS_PATH"),
+    "MODEL_PATH":        os.getenv("MODEL_PATH"),
+    "WORKING_DIR":       os.getenv("WORKING_DIR"),
+    "INDEX_PATH":        os.getenv("INDEX_PATH") or os.path.join(os.getenv("DOWNLOADS_PATH", ""), "index"),
+    "ANN_NPROBE":        int(os.getenv("ANN_NPROBE") or 8),
+    "RERANK_DEPTH":      int(os.getenv("RERANK_DEPTH") or 100),
+    "SEARCH_MODE":       os.getenv("SEARCH_MODE", "dense").lower(),
+    "PREFILTER_DEPTH":   int(os.getenv("PREFILTER_DEPTH") or 200),
+    "FUSION_DEPTH":      int(os.getenv("FUSION_DEPTH") or 50),
+    "RESULT_CACHE_SIZE": int(os.getenv("RESULT_CACHE_SIZE") or 1024),
+    "RESULT_CACHE_TTL":  float(os.getenv("RESULT_CACHE_TTL") or 600),
+
+    "STORAGE_BACKEND":   os.getenv("STORAGE_BACKEND", "mysql"),
+    "SQLITE_PATH":       os.getenv("SQLITE_PATH") or os.path.join(os.getenv("DOWNLOADS_PATH", ""), "documents.db"),
+    "HOST":              os.getenv("MYSQL_HOST"),
+    "PORT":              os.getenv("MYSQL_PORT"),
+    "USER":              os.getenv("MYSQL_USER"),
+    "PASSWORD":          os.getenv("MYSQL_PASSWORD"),
+    "DATABASE":          os.getenv("MYSQL_DATABASE"),
+}
+
+SEARCH_MODES = ("dense", "bm25", "hybrid", "prefilter")
+
+
+def preprocess_query(query_text):
+    return process_text(query_text)
+
+
+def load_model():
+    # gensim takes over a second to import, only the storage fallback and old bundles pay for it
+    with metrics.timer("query.load_model"):
+        from gensim.models import Word2Vec
+        return Word2Vec.load(config["MODEL_PATH"])
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def fetch_generation():
+    return open_storage(config).fetch_generation()
+
+
+def fetch_documents():
+    results = open_storage(config).fetch_rows()
+
+    paths = [file_path for file_path, _ in results]
+    vectors = [vector for _, vector in results]
+
+    # Tables that haven't been migrated still hold semicolon-joined text
+    if any(isinstance(vector, str) for vector in vectors):
+        print("webpages still stores text vectors, run setup/upload.py --migrate", file=sys.stderr)
+        return paths, np.array([parse_legacy_vector(vector) for vector in vectors], dtype=np.float32)
+
+    return paths, decode_matrix(vectors)
+
+
+def top_k(scores, k):
+    # Indices of the k highest scores in every row, highest first, without sorting whole rows
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.intp)
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def rank_rows(matrix, queries, k, rows=None):
+    # Cosine similarity of every query against every row in one matrix multiply, or only against rows
+    # (ascending ids) for filtered searches
+    if rows is None:
+        scores = queries @ matrix.T
+        return [(ids, row[ids]) for ids, row in zip(top_k(scores, k), scores)]
+    scores = queries @ matrix[rows].T
+    return [(rows[ids], row[ids]) for ids, row in zip(top_k(scores, k), scores)]
+
+
+class Index:
+    # Holds the model and the normalized document matrix so they are only loaded once
+    def __init__(self, model, paths, matrix, ann=None, passages=None, sparse=None, passage_sparse=None,
+                 source="storage", generation=0, preprocess=preprocess_query, compact=None, filters=None):
+        self.model = model
+        self.preprocess = preprocess
+        self.paths = paths
+        self.matrix = matrix
+        self.ann = ann
+
+        # float16 or int8 copy of the matrix scored first, only bundles built with VECTOR_PRECISION have one
+        self.compact = compact
+        self.passages = passages
+
+        # Sorted metadata keys for filtered search, see setup/filters.py, bundles only
+        self.filters = filters
+
+        # BM25 indexes over documents and passages, only present in bundles built with BM25_INDEX
+        self.sparse = sparse
+        self.passage_sparse = passage_sparse
+
+        # Where the vectors came from and which published generation they are, see current_generation
+        self.source = source
+        self.generation = generation
+
+        # Every loaded index gets its own result cache, so reloading the index or model starts from an
+        # empty one, and keys carry the version as well
+        self.version = (source, generation)
+        self.cache = None
+        if config["RESULT_CACHE_SIZE"] > 0:
+            self.cache = ResultCache(config["RESULT_CACHE_SIZE"], config["RESULT_CACHE_TTL"])
+            # Tokenizing dominates a cache hit, so raw query text -> tokens is memoized as well
+            self.token_cache = ResultCache(config["RESULT_CACHE_SIZE"], 0)
+
+    def vectorize(self, tokens):
+        word_vecs = [self.model.wv[word] for word in tokens if word in self.model.wv]
+        if not word_vecs:
+            return None
+        return np.mean(word_vecs, axis=0)
+
+    def search(self, query_text, k=5, passages=False, mode=None, shards=None, filters=None):
+        return self.search_batch([query_text], k, passages, mode, shards, filters)[0]
+
+    def search_batch(self, query_texts, k=5, passages=False, mode=None, shards=None, filters=None):
+        # Results are (path, score), or (path, score, start, end) byte ranges when passages are asked for.
+        # Without a passage index whole documents come back with no range.
+        # mode is one of SEARCH_MODES, the sparse modes fall back to dense without a BM25 index.
+        # filters are predicates like "url_path^=/site/api/", only matching documents are scored.
+        if shards:
+            raise ValueError("No shards are configured, the index is a single one")
+        mode = mode or config["SEARCH_MODE"]
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode {mode!r}, expected one of {', '.join(SEARCH_MODES)}")
+
+        filters = parse_filters(filters)
+        rows = None
+        if filters:
+            if self.filters is None:
+                raise ValueError("Filtered search needs an index bundle, run setup/processor.py")
+            with metrics.timer("query.filter"):
+                rows = self.filters.resolve(filters)
+
+        metrics.count("query.queries", len(query_texts))
+        if self.cache is None:
+            with metrics.timer("query.preprocess"):
+                token_lists = [self.preprocess(query_text) for query_text in query_texts]
+            return self.search_tokens(token_lists, k, passages, mode, rows)
+
+        # Queries that stem to the same tokens share one cache entry
+        with metrics.timer("query.preprocess"):
+            token_lists = [self.query_tokens(query_text) for query_text in query_texts]
+        keys = [(self.version, tokens, k, passages, mode, filters) for tokens in token_lists]
+        results = [self.cache.get(key) for key in keys]
+        missed = {}
+        for i, result in enumerate(results):
+            if result is None:
+                missed.setdefault(keys[i], token_lists[i])
+        metrics.count("query.cache_hits", len(query_texts) - len(missed))
+        if missed:
+            computed = dict(zip(missed, self.search_tokens(list(missed.values()), k, passages, mode, rows)))
+            for key, result in computed.items():
+                self.cache.put(key, result)
+            results = [result if result is not None else computed[key] for key, result in zip(keys, results)]
+        return [list(result) for result in results]
+
+    def query_tokens(self, query_text):
+        tokens = self.token_cache.get(query_text)
+        if tokens is None:
+            tokens = tuple(self.preprocess(query_text))
+            self.token_cache.put(query_text, tokens)
+        return tokens
+
+    def search_tokens(self, token_lists, k, passages, mode, rows=None):
+        with metrics.timer("query.score"):
+            return self.score_tokens(token_lists, k, passages, mode, rows)
+
+    def score_tokens(self, token_lists, k, passages, mode, rows=None):
+        # rows are the ascending document ids a filter matched, None scores every document
+        results = [[] for _ in token_lists]
+        if rows is not None and len(rows) == len(self.paths):
+            rows = None
+        if not self.paths or (rows is not None and not len(rows)):
+            return results
+
+        use_passages = passages and self.passages is not None
+        if use_passages and rows is not None:
+            rows = passage_rows(self.passages[PASSAGE_DOCS], rows)
+        sparse = self.passage_sparse if use_passages else self.sparse
+        if sparse is None:
+            mode = "dense"
+
+        # Overlapping passages are dropped after ranking, so rank deeper than k
+        depth = k * 4 if use_passages else k
+
+        query_vecs = [self.vectorize(tokens) for tokens in token_lists]
+        known = [i for i, vec in enumerate(query_vecs) if vec is not None]
+        rankings = [None] * len(token_lists)
+
+        # Stack the normalized mean vector of every query that has known words and score them together
+        if mode in ("dense", "hybrid") and known:
+            queries = normalize_rows(np.array([query_vecs[i] for i in known], dtype=np.float32))
+            dense_depth = depth if mode == "dense" else max(depth, config["FUSION_DEPTH"])
+            for i, ranking in zip(known, self.rank_dense(queries, dense_depth, use_passages, rows)):
+                rankings[i] = ranking
+
+        if mode != "dense":
+            for i, tokens in enumerate(token_lists):
+                rankings[i] = self.rank_sparse(mode, sparse, tokens, query_vecs[i], rankings[i], depth, use_passages, rows)
+
+        for i, ranking in enumerate(rankings):
+            if ranking is not None:
+                results[i] = self.format_results(ranking, k, passages, use_passages)
+        return results
+
+    def rank(self, queries, k, rows=None):
+        # Only score the candidate lists of the ANN index when the bundle has one. Filtered searches
+        # score their rows exactly instead, the probed lists could hold fewer than k of them.
+        if self.ann is not None and rows is None:
+            return search_ivf(self.ann, self.matrix, queries, k, config["ANN_NPROBE"])
+
+        # Score the compact matrix, then re-rank its best candidates with the full vectors
+        if self.compact is not None:
+            return search_compact(self.compact, self.matrix, queries, k, config["RERANK_DEPTH"], rows)
+
+        return rank_rows(self.matrix, queries, k, rows)
+
+    def rank_dense(self, queries, k, use_passages, rows=None):
+        if not use_passages:
+            return self.rank(queries, k, rows)
+        return rank_rows(self.passages[PASSAGES], queries, k, rows)
+
+    def rank_sparse(self, mode, sparse, tokens, query_vec, dense_ranking, k, use_passages, rows=None):
+        if mode == "bm25":
+            return sparse.search(tokens, k, rows)
+
+        if mode == "hybrid":
+            # Reciprocal rank fusion of the dense and BM25 rankings, scores are fused rank scores
+            rankings = [sparse.search(tokens, config["FUSION_DEPTH"], rows)]
+            if dense_ranking is not None:
+                rankings.insert(0, dense_ranking)
+            return fuse_ranks(rankings, k)
+
+        # Prefilter, BM25 picks the candidates and only their rows get dense scores
+        candidates, bm25_scores = sparse.search(tokens, config["PREFILTER_DEPTH"], rows)
+        if query_vec is None:
+            return candidates[:k], bm25_scores[:k]
+        query = normalize_rows(np.array([query_vec], dtype=np.float32))
+        if not len(candidates):
+            # No lexical match at all, score everything
+            return self.rank_dense(query, k, use_passages, rows)[0]
+        candidates = np.sort(candidates)
+        matrix = self.passages[PASSAGES] if use_passages else self.matrix
+        scores = matrix[candidates] @ query[0]
+        top = top_k(scores[None], k)[0]
+        return candidates[top], scores[top]
+
+    def format_results(self, ranking, k, passages, use_passages):
+        ids, scores = ranking
+        if use_passages:
+            docs, ranges = self.passages[PASSAGE_DOCS], self.passages[PASSAGE_RANGES]
+            ids, scores = select_passages(ids, scores, docs, ranges, k)
+            return [(self.paths[docs[idx]], float(score), int(ranges[idx][0]), int(ranges[idx][1]))
+                    for idx, score in zip(ids, scores)]
+        return [(self.paths[idx], float(score)) + ((None, None) if passages else ())
+                for idx, score in zip(ids[:k], scores[:k])]
+
+
+def load_bundle_index(index_path):
+    with metrics.timer("query.load_bundle"):
+        manifest, matrix = load_bundle(index_path)
+
+    # The exported query model was written together with the matrix, so it always matches it.
+    # Older bundles need the gensim model, checked against the one the matrix was built with.
+    with metrics.timer("query.load_query_model"):
+        query_model = load_query_model(index_path, manifest)
+    if query_model is not None:
+        model, preprocessor = query_model
+        preprocess = preprocessor.process
+    else:
+        model = load_model()
+        preprocess = preprocess_query
+        if manifest["model_fingerprint"] != model_fingerprint(model):
+            print("Index bundle was built with a different model, reading vectors from storage", file=sys.stderr)
+            return None
+
+    # Rows are already normalized by the processor, score straight from the memory-mapped matrix
+    paths = [document["file_path"] for document in manifest["documents"]]
+    ann = {name: load_array(index_path, manifest, name) for name in (CENTROIDS, OFFSETS, IDS)}
+    compact = {name: load_array(index_path, manifest, name) for name in (F16, I8, SCALE)}
+    compact = {name: array for name, array in compact.items() if array is not None}
+    passages = {name: load_array(index_path, manifest, name) for name in (PASSAGES, PASSAGE_DOCS, PASSAGE_RANGES)}
+    sparse = {name: load_array(index_path, manifest, name) for name in BM25_NAMES}
+    passage_sparse = {name: load_array(index_path, manifest, "passage_" + name) for name in BM25_NAMES}
+    return Index(model, paths, matrix,
+                 ann if all(array is not None for array in ann.values()) else None,
+                 passages if all(array is not None for array in passages.values()) else None,
+                 BM25(sparse) if all(array is not None for array in sparse.values()) else None,
+                 BM25(passage_sparse) if all(array is not None for array in passage_sparse.values()) else None,
+                 source="bundle", generation=manifest["generation"], preprocess=preprocess,
+                 compact=compact if F16 in compact or {I8, SCALE} <= compact.keys() else None,
+                 filters=load_filters(index_path, manifest))
+
+
+class ShardedIndex:
+    # One Index per shard, searched in parallel and merged by score. Shards are scored independently,
+    # so BM25 scores (per shard IDF) compare less well across shards than cosine or fused scores.
+    def __init__(self, shards, generation=None):
+        self.shards = shards
+        self.paths = [path for index in shards.values() for path in index.paths]
+        self.source = "shards"
+        # Generation of every shard bundle found when loading, skipped ones included, see current_generation
+        self.generation = generation or {name: index.generation for name, index in shards.items()}
+        self.cache = None
+        self.executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix="shard")
+
+    def search(self, query_text, k=5, passages=False, mode=None, shards=None, filters=None):
+        return self.search_batch([query_text], k, passages, mode, shards, filters)[0]
+
+    def search_batch(self, query_texts, k=5, passages=False, mode=None, shards=None, filters=None):
+        # shards restricts the search to the named shards, numpy releases the GIL while they score.
+        # Every shard applies the filters to its own documents.
+        names = select_shards(self.shards, shards)
+        futures = [self.executor.submit(self.shards[name].search_batch, query_texts, k, passages, mode, None, filters)
+                   for name in names]
+        per_shard = [future.result() for future in futures]
+        return [heapq.nlargest(k, (result for results in per_shard for result in results[i]), key=lambda result: result[1])
+                for i in range(len(query_texts))]
+
+
+def shard_generations(shards):
+    # Published generation of every configured shard that has a bundle
+    return {name: read_manifest(shard_index_path(name))["generation"]
+            for name in shards if bundle_exists(shard_index_path(name))}
+
+
+def load_sharded_index(shards):
+    generation = shard_generations(shards)
+    indexes = {}
+    for name in shards:
+        index_path = shard_index_path(name)
+        if not bundle_exists(index_path):
+            print(f"Shard {name} has no index bundle yet, run setup.py --shard {name}", file=sys.stderr)
+            continue
+        index = load_bundle_index(index_path)
+        if index is None:
+            print(f"Skipping shard {name}, its bundle has no query model", file=sys.stderr)
+            continue
+        indexes[name] = index
+    if not indexes:
+        raise ValueError("None of the configured shards has an index bundle")
+    return ShardedIndex(indexes, generation)
+
+
+def load_index():
+    # With shards.json every shard bundle is loaded, otherwise the single index
+    shards = load_shards()
+    if shards:
+        return load_sharded_index(shards)
+
+    if bundle_exists(config["INDEX_PATH"]):
+        try:
+            index = load_bundle_index(config["INDEX_PATH"])
+        except ValueError as e:
+            print(f"Skipping index bundle: {e}", file=sys.stderr)
+            index = None
+        if index is not None:
+            return index
+
+    # Read the generation first, an upload racing the fetch just shows up as a newer generation later
+    with metrics.timer("query.fetch_documents"):
+        generation = fetch_generation()
+        paths, matrix = fetch_documents()
+
+    model = load_model()
+    with metrics.timer("query.normalize"):
+        matrix = normalize_rows(matrix.reshape(len(paths), model.vector_size))
+    return Index(model, paths, matrix, generation=generation)
+
+
+def current_generation(index):
+    # Latest published generation of the source the index was loaded from, cheap enough to poll.
+    # shards.json is read again on every poll, so a shard built, rebuilt, added or dropped since the
+    # index was loaded shows up as a new generation, as does a first shard built next to a single index.
+    shards = load_shards()
+    if shards:
+        generation = shard_generations(shards)
+        if generation or index.source == "shards":
+            return generation
+    elif index.source == "shards":
+        return {}
+    if index.source == "bundle":
+        return read_manifest(config["INDEX_PATH"])["generation"]
+    return fetch_generation()
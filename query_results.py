@@ -0,0 +1,17 @@
+# JSON form of a search result, shared by the query server and query.py. Kept out of query_engine so
+# query.py can talk to the server without importing numpy and the index code.
+
+
+def result_json(result):
+    # (path, score) or (path, score, start, end) for passages
+    body = {"path": result[0], "score": result[1]}
+    if len(result) == 4:
+        body["start"], body["end"] = result[2], result[3]
+    return body
+
+
+def result_tuple(body):
+    # The inverse of result_json, for results returned by the query server
+    if "start" in body:
+        return (body["path"], body["score"], body["start"], body["end"])
+    return (body["path"], body["score"])
@@ -0,0 +1,179 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from dotenv import load_dotenv
+
+import query_engine
+from query_results import result_json
+import metrics
+
+load_dotenv()
+
+config = {
+    "QUERY_SERVER_HOST": os.getenv("QUERY_SERVER_HOST", "127.0.0.1"),
+    "QUERY_SERVER_PORT": int(os.getenv("QUERY_SERVER_PORT", "8765")),
+    "RELOAD_INTERVAL":   float(os.getenv("QUERY_SERVER_RELOAD_INTERVAL") or 30),
+    "TOP_K":             5,
+}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    index = None
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        params = parse_qs(parsed.query)
+
+        if parsed.path == "/health":
+            index = self.index
+            self.send_json(200, {"status": "ok", "documents": len(index.paths),
+                                 "source": index.source, "generation": index.generation})
+            return
+
+        if parsed.path == "/stats":
+            index = self.index
+            stats = {"source": index.source, "generation": index.generation, "documents": len(index.paths)}
+            self.send_json(200, {**stats, "cache": index.cache.stats() if index.cache is not None else None})
+            return
+
+        if parsed.path == "/metrics":
+            # Stage timers and counters since startup in the Prometheus text format, with METRICS set
+            if not metrics.enabled():
+                self.send_json(404, {"error": "Metrics are off, start the server with METRICS=prometheus or json"})
+                return
+            payload = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        if parsed.path != "/query" or "q" not in params:
+            self.send_json(400, {"error": "Usage: /query?q=<query>&k=<top k>&passages=<0|1>&mode=<search mode>&shards=<a,b>"
+                                          "&filter=<field=value or field^=prefix>"})
+            return
+
+        try:
+            k = int(params.get("k", [config["TOP_K"]])[0])
+        except ValueError:
+            k = 0
+        if k < 1:
+            self.send_json(400, {"error": "k must be a positive integer"})
+            return
+
+        passages = params.get("passages", ["0"])[0].lower() in ("1", "true", "yes")
+        mode = params.get("mode", [None])[0]
+        if mode is not None and mode not in query_engine.SEARCH_MODES:
+            self.send_json(400, {"error": f"mode must be one of {', '.join(query_engine.SEARCH_MODES)}"})
+            return
+
+        shards = [name for name in params.get("shards", [""])[0].split(",") if name]
+        filters = params.get("filter", [])
+        start = time.perf_counter()
+        try:
+            results = self.index.search(params["q"][0], k, passages, mode, shards, filters)
+        except ValueError as e:
+            # Unknown shard names, shards asked of an index without any, or invalid filters
+            self.send_json(400, {"error": str(e)})
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        self.send_json(200, {
+            "results": [result_json(result) for result in results],
+            "elapsed_ms": elapsed_ms,
+        })
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/batch":
+            self.send_json(404, {"error": "Unknown endpoint"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+            queries = body["queries"]
+            # A bare string would otherwise be scored one character at a time
+            if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+                raise TypeError("queries must be a list of strings")
+            k = int(body.get("k", config["TOP_K"]))
+            passages = bool(body.get("passages", False))
+            mode = body.get("mode")
+            if mode is not None and mode not in query_engine.SEARCH_MODES:
+                raise ValueError(mode)
+            shards = [str(name) for name in body.get("shards") or []]
+            filters = [str(predicate) for predicate in body.get("filters") or []]
+        except (KeyError, TypeError, ValueError):
+            self.send_json(400, {"error": "Expected a JSON body {\"queries\": [...], \"k\": <top k>, \"passages\": <bool>, \"mode\": <search mode>, \"shards\": [...], \"filters\": [...]}"})
+            return
+        if k < 1:
+            self.send_json(400, {"error": "k must be a positive integer"})
+            return
+
+        start = time.perf_counter()
+        try:
+            results = self.index.search_batch(queries, k, passages, mode, shards, filters)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        self.send_json(200, {
+            "results": [[result_json(result) for result in batch] for batch in results],
+            "elapsed_ms": elapsed_ms,
+        })
+
+    def log_message(self, format, *args):
+        # Keep the console quiet, the chatbot calls this on every turn
+        pass
+
+
+def watch_index(interval):
+    # Poll the published generation and swap in a freshly loaded index when it moves.
+    # Requests already running keep the index they started with.
+    while True:
+        time.sleep(interval)
+        try:
+            if query_engine.current_generation(QueryHandler.index) == QueryHandler.index.generation:
+                continue
+            index = query_engine.load_index()
+        except Exception as e:
+            print(f"Index reload failed, still serving generation {QueryHandler.index.generation}: {e}", file=sys.stderr)
+            continue
+        QueryHandler.index = index
+        print(f"Reloaded index generation {index.generation} ({len(index.paths)} documents)")
+
+
+def main():
+    print("Loading model and document index...")
+    QueryHandler.index = query_engine.load_index()
+
+    if config["RELOAD_INTERVAL"] > 0:
+        threading.Thread(target=watch_index, args=(config["RELOAD_INTERVAL"],), daemon=True).start()
+
+    server = ThreadingHTTPServer((config["QUERY_SERVER_HOST"], config["QUERY_SERVER_PORT"]), QueryHandler)
+    print(f"Query server listening on http://{config['QUERY_SERVER_HOST']}:{config['QUERY_SERVER_PORT']} "
+          f"({len(QueryHandler.index.paths)} documents)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
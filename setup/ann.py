@@ -0,0 +1,111 @@
+import time
+import numpy as np
+
+# Inverted file (IVF) approximate nearest neighbour index over the normalized document matrix.
+# Documents are clustered around coarse centroids with spherical k-means, a query only scores the
+# documents in its `nprobe` closest lists, and those candidates are re-ranked with their exact
+# vectors. Raising nprobe trades latency for recall, nprobe == n_lists is exhaustive search.
+CENTROIDS = "ann_centroids"
+OFFSETS = "ann_offsets"
+IDS = "ann_ids"
+
+
+def default_lists(n_docs):
+    return max(1, int(round(4 * np.sqrt(n_docs))))
+
+
+def assign(matrix, centroids, chunk_size=8192):
+    # Closest centroid (highest cosine) for every row, chunked to bound the score matrix size
+    labels = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], chunk_size):
+        chunk = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+        labels[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return labels
+
+
+def kmeans(matrix, n_lists, iterations=10, sample_size=None, seed=0):
+    rng = np.random.default_rng(seed)
+    n_docs = matrix.shape[0]
+
+    # Train on a sample, a few dozen points per list is plenty for coarse centroids
+    sample_size = min(n_docs, sample_size or max(64 * n_lists, 10000))
+    sample = np.asarray(matrix[np.sort(rng.choice(n_docs, sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=n_lists)
+
+        # Re-seed empty lists from random sample points
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = (sums / norms).astype(np.float32)
+
+    return centroids
+
+
+def build_ivf(matrix, n_lists=None):
+    n_lists = min(n_lists or default_lists(matrix.shape[0]), matrix.shape[0])
+    centroids = kmeans(matrix, n_lists)
+    labels = assign(matrix, centroids)
+
+    # Document ids grouped by list, offsets[i]:offsets[i + 1] spans list i
+    ids = np.argsort(labels, kind="stable").astype(np.int32)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_lists))
+
+    return {CENTROIDS: centroids, OFFSETS: offsets, IDS: ids}
+
+
+def search_ivf(ivf, matrix, queries, k, nprobe):
+    centroids, offsets, ids = ivf[CENTROIDS], ivf[OFFSETS], ivf[IDS]
+    nprobe = max(1, min(nprobe, len(centroids)))
+
+    # Lists for every query at once, closest first
+    probes = np.argsort(-(queries @ centroids.T), axis=1)
+    sizes = np.diff(offsets)
+
+    results = []
+    for query, lists in zip(queries, probes):
+        # Probe nprobe lists, and keep going while they hold fewer than k documents
+        enough = np.searchsorted(np.cumsum(sizes[lists]), min(k, len(ids)))
+        candidates = np.concatenate([ids[offsets[i]:offsets[i + 1]] for i in lists[:max(nprobe, enough + 1)]])
+        if not len(candidates):
+            results.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+            continue
+
+        # Exact re-rank of the candidate set with the full vectors
+        candidates = np.sort(candidates)
+        scores = matrix[candidates] @ query
+        top = np.argsort(-scores, kind="stable")[:k]
+        results.append((candidates[top], scores[top]))
+    return results
+
+
+def recall_at_k(matrix, search, k=5, n_queries=200, seed=0):
+    # Recall of an approximate search against brute force over the float32 matrix, with jittered
+    # document vectors as queries. search(queries, k) returns an (ids, scores) pair per query, this
+    # measures the IVF index and the compact matrices alike.
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(matrix.shape[0], min(n_queries, matrix.shape[0]), replace=False)
+    queries = np.asarray(matrix[picks], dtype=np.float32) + rng.normal(0, 0.05, (len(picks), matrix.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    k = min(k, matrix.shape[0])
+
+    start = time.perf_counter()
+    exact_scores = queries @ np.asarray(matrix, dtype=np.float32).T
+    kth = -np.partition(-exact_scores, k - 1, axis=1)[:, k - 1]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    approx = search(queries, k)
+    approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    # A hit is any result scoring at least the k-th exact score, duplicate documents tie
+    hits = sum(int(np.sum(scores >= threshold - 1e-6)) for threshold, (_, scores) in zip(kth, approx))
+    return hits / (len(queries) * k), exact_ms, approx_ms
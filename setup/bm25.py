@@ -0,0 +1,122 @@
+import hashlib
+from array import array
+from collections import Counter
+import numpy as np
+
+# Sparse BM25 index over the same process_text tokens the word2vec model sees, stored as bundle arrays:
+#   bm25_hashes    sorted uint64 hash of every term, looked up with a binary search
+#   bm25_offsets   CSR offsets, the postings of term i are [offsets[i], offsets[i + 1])
+#   bm25_docs      document (or passage) id of every posting, ascending within a term
+#   bm25_freqs     term frequency of every posting
+#   bm25_idf       precomputed IDF of every term
+#   bm25_lengths   token count of every document
+# A query only reads the postings of its own terms, never the whole collection.
+HASHES = "bm25_hashes"
+OFFSETS = "bm25_offsets"
+DOCS = "bm25_docs"
+FREQS = "bm25_freqs"
+IDF = "bm25_idf"
+LENGTHS = "bm25_lengths"
+NAMES = (HASHES, OFFSETS, DOCS, FREQS, IDF, LENGTHS)
+K1 = 1.2
+B = 0.75
+FUSION_K = 60
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def build_bm25(corpus):
+    term_ids = {}
+    posting_docs = array("i")
+    posting_terms = array("i")
+    posting_freqs = array("I")
+    lengths = array("f")
+    for doc_idx, tokens in enumerate(corpus):
+        lengths.append(len(tokens))
+        for term, freq in Counter(tokens).items():
+            term_id = term_ids.setdefault(term, len(term_ids))
+            posting_docs.append(doc_idx)
+            posting_terms.append(term_id)
+            posting_freqs.append(freq)
+
+    # Number terms in hash order, then group postings by term keeping document order within each term
+    hashes = np.fromiter((term_hash(term) for term in term_ids), dtype=np.uint64, count=len(term_ids))
+    order = np.argsort(hashes, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    terms = rank[np.frombuffer(posting_terms, dtype=np.int32)] if len(posting_terms) else np.empty(0, dtype=np.intp)
+    by_term = np.argsort(terms, kind="stable")
+
+    doc_freqs = np.bincount(terms, minlength=len(term_ids))
+    n_docs = len(lengths)
+    return {
+        HASHES:  hashes[order],
+        OFFSETS: np.concatenate(([0], np.cumsum(doc_freqs))).astype(np.int64),
+        DOCS:    np.frombuffer(posting_docs, dtype=np.int32)[by_term],
+        FREQS:   np.frombuffer(posting_freqs, dtype=np.uint32)[by_term],
+        IDF:     np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32),
+        LENGTHS: np.frombuffer(lengths, dtype=np.float32).copy(),
+    }
+
+
+class BM25:
+    def __init__(self, arrays, k1=K1, b=B):
+        self.hashes = arrays[HASHES]
+        self.offsets = arrays[OFFSETS]
+        self.docs = arrays[DOCS]
+        self.freqs = arrays[FREQS]
+        self.idf = arrays[IDF]
+        self.lengths = arrays[LENGTHS]
+        self.k1 = k1
+        self.b = b
+        self.avg_length = float(np.mean(self.lengths)) if len(self.lengths) else 0.0
+
+    def term_ids(self, tokens):
+        ids = []
+        for term in set(tokens):
+            value = np.uint64(term_hash(term))
+            pos = int(np.searchsorted(self.hashes, value))
+            if pos < len(self.hashes) and self.hashes[pos] == value:
+                ids.append(pos)
+        return ids
+
+    def search(self, tokens, k, rows=None):
+        # Accumulate BM25 contributions over the query terms' postings only, then take the top k.
+        # rows (ascending ids) drops every posting outside them before it is scored.
+        docs = []
+        contributions = []
+        for term_id in self.term_ids(tokens):
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            term_docs = self.docs[start:end]
+            freqs = self.freqs[start:end]
+            if rows is not None:
+                keep = rows[np.minimum(np.searchsorted(rows, term_docs), len(rows) - 1)] == term_docs
+                term_docs, freqs = term_docs[keep], freqs[keep]
+                if not len(term_docs):
+                    continue
+            freqs = freqs.astype(np.float32)
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[term_docs] / self.avg_length)
+            docs.append(term_docs)
+            contributions.append(self.idf[term_id] * freqs * (self.k1 + 1) / (freqs + norm))
+        if not docs:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+
+        ids, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return ids[top], scores[top]
+
+
+def fuse_ranks(rankings, k):
+    # Reciprocal rank fusion, every ranking adds 1 / (FUSION_K + rank) for each id it returns
+    fused = {}
+    for ids, _ in rankings:
+        for rank, idx in enumerate(ids):
+            fused[int(idx)] = fused.get(int(idx), 0.0) + 1.0 / (FUSION_K + rank + 1)
+    best = sorted(fused.items(), key=lambda item: -item[1])[:k]
+    return (np.array([idx for idx, _ in best], dtype=np.intp),
+            np.array([score for _, score in best], dtype=np.float32))
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# On-disk index bundle written by processor.main and opened by the query path:
+#   manifest.json           bundle version, generation, matrix shape, model fingerprint, data files and document rows
+#   vectors.<gen>.npy       contiguous float32 matrix of normalized document vectors, one row per document
+#   <name>.<gen>.npy        optional extra arrays (ANN lists and the like), listed under "files" in the manifest
+# Every build writes a new generation of data files and then swaps the manifest, so readers that still
+# have the previous matrix mapped keep working and the old files are removed once nothing holds them.
+BUNDLE_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+
+
+def model_fingerprint(model):
+    digest = hashlib.sha256()
+    digest.update(str(model.vector_size).encode("utf-8"))
+    digest.update("\n".join(model.wv.index_to_key).encode("utf-8"))
+    digest.update(np.ascontiguousarray(model.wv.vectors, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+def save_atomic(path, write):
+    # Write next to the target and swap it in so readers never see a half written file
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_array(path, array):
+    with open(path, "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+
+
+def read_manifest(index_path):
+    with open(os.path.join(index_path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class BundleWriter:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        os.makedirs(index_path, exist_ok=True)
+
+        previous = read_manifest(index_path) if bundle_exists(index_path) else {}
+        self.generation = previous.get("generation", 0) + 1
+        self.files = {}
+        self.matrix = None
+        self.memmaps = []
+
+        # Extra manifest fields, e.g. the preprocessing version the query model was exported with
+        self.meta = {}
+
+    def file_name(self, name):
+        return f"{name}.{self.generation}.npy"
+
+    def open_array(self, name, shape, dtype=np.float32):
+        # Rows are written straight into a memory-mapped file, the array never has to fit in memory
+        self.files[name] = self.file_name(name)
+        array = np.lib.format.open_memmap(
+            os.path.join(self.index_path, self.files[name]), mode="w+", dtype=dtype, shape=shape)
+        self.memmaps.append(array)
+        return array
+
+    def open_vectors(self, count, dim):
+        self.matrix = self.open_array("vectors", (count, dim))
+        return self.matrix
+
+    def add_array(self, name, array):
+        self.files[name] = self.file_name(name)
+        save_array(os.path.join(self.index_path, self.files[name]), array)
+
+    def commit(self, csv_data, model):
+        for array in self.memmaps:
+            array.flush()
+        manifest = {
+            "version":           BUNDLE_VERSION,
+            "generation":        self.generation,
+            "created":           time.time(),
+            "count":             self.matrix.shape[0],
+            "dim":               self.matrix.shape[1],
+            "model_fingerprint": model_fingerprint(model),
+            "files":             self.files,
+            **self.meta,
+            "documents":         [document_record(row) for row in csv_data],
+        }
+
+        def write_manifest(path):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+
+        # Data files are all written, the manifest swap is what publishes the new generation
+        save_atomic(os.path.join(self.index_path, MANIFEST_FILE), write_manifest)
+        self.remove_old_files()
+        print(f"Index bundle generation {self.generation} saved to {self.index_path}...")
+
+    def remove_old_files(self):
+        current = set(self.files.values())
+        for file_name in os.listdir(self.index_path):
+            if file_name.endswith(".npy") and file_name not in current:
+                try:
+                    os.remove(os.path.join(self.index_path, file_name))
+                except OSError:
+                    # Still mapped by a running query process (Windows), the next build cleans it up
+                    pass
+
+
+def document_record(row):
+    # Manifest entry of a data.csv row
+    return {"file_name": row[0], "page_name": row[1], "file_path": row[2], "url": row[3]}
+
+
+def bundle_exists(index_path):
+    return bool(index_path) and os.path.exists(os.path.join(index_path, MANIFEST_FILE))
+
+
+def load_bundle(index_path):
+    manifest = read_manifest(index_path)
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise ValueError(f"Unsupported index bundle version {manifest.get('version')}, rerun processor.py")
+
+    # Memory-map the matrix so startup doesn't depend on corpus size and processes share the page cache
+    matrix = np.load(os.path.join(index_path, manifest["files"]["vectors"]), mmap_mode="r")
+    if matrix.shape != (manifest["count"], manifest["dim"]):
+        raise ValueError(f"Index bundle matrix is {matrix.shape}, manifest says {(manifest['count'], manifest['dim'])}")
+
+    return manifest, matrix
+
+
+def load_array(index_path, manifest, name):
+    # Extra arrays are only trusted when the current manifest lists them
+    file_name = manifest["files"].get(name)
+    if file_name is None:
+        return None
+    return np.load(os.path.join(index_path, file_name), mmap_mode="r")
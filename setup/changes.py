@@ -0,0 +1,58 @@
+import json
+import os
+
+# Change manifest written by the crawler and consumed by the processor and uploader in incremental mode.
+# Lists file names from data.csv that were added, whose cleaned content hash changed, or that are gone.
+CHANGES_FILE = "changes.json"
+
+
+def diff_index(old_rows, new_rows):
+    # Rows are data.csv rows, file name first and content hash fifth
+    old_hashes = {row[0]: (row[4] if len(row) > 4 else None) for row in old_rows}
+    new_hashes = {row[0]: (row[4] if len(row) > 4 else None) for row in new_rows}
+
+    return {
+        "added":   sorted(name for name in new_hashes if name not in old_hashes),
+        "changed": sorted(name for name, content_hash in new_hashes.items()
+                          if name in old_hashes and (content_hash is None or old_hashes[name] != content_hash)),
+        "removed": sorted(name for name in old_hashes if name not in new_hashes),
+    }
+
+
+def merge_changes(pending, changes, names):
+    # Changes the uploader hasn't published yet carry over into the next crawl's, names are the
+    # file names in the new data.csv. A page added and then changed is still added, a page gone now
+    # is removed whatever happened to it before.
+    added = (set(pending["added"]) | set(changes["added"])) & names
+    changed = (set(pending["changed"]) | set(changes["changed"])) & names
+    return {
+        "added":   sorted(added),
+        "changed": sorted(changed - added),
+        "removed": sorted((set(pending["removed"]) | set(changes["removed"])) - names),
+    }
+
+
+def has_changes(changes):
+    return any(changes[key] for key in ("added", "changed", "removed"))
+
+
+def save_changes(downloads_path, changes):
+    with open(os.path.join(downloads_path, CHANGES_FILE), "w", encoding="utf-8") as f:
+        json.dump(changes, f, indent=2)
+
+    print(f"{len(changes['added'])} added, {len(changes['changed'])} changed, {len(changes['removed'])} removed documents...")
+
+
+def clear_changes(downloads_path):
+    # Called once the changes are published, the next crawl starts a new change set
+    path = os.path.join(downloads_path, CHANGES_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def load_changes(downloads_path):
+    path = os.path.join(downloads_path, CHANGES_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -1,38 +1,100 @@
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-import time
-import random
+from bs4 import BeautifulSoup, NavigableString, Tag
+from urllib.parse import urljoin, urlparse, urlunparse, parse_qsl, urlencode
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from collections import deque
+import hashlib
+import json
 import re
 import os
 from dotenv import load_dotenv
+from fetcher import HostRateLimiter, create_session, fetch
+from changes import diff_index, load_changes, merge_changes, save_changes
+import metrics
 
 load_dotenv()
 
 config = {
-    "START_URL":        "https://www.opendental.com/site/apispecification.html",
-    "MAX_DEPTH":        2,
-    "BLACKLIST":        [],
-    "WHITELIST":        ["https://www.opendental.com/site/api"],
+    "START_URL":        os.getenv("CRAWL_START_URL") or "https://www.opendental.com/site/apispecification.html",
+    "MAX_DEPTH":        int(os.getenv("CRAWL_MAX_DEPTH") or 2),
+    "BLACKLIST":        [url for url in os.getenv("CRAWL_BLACKLIST", "").split(",") if url],
+    "WHITELIST":        [url for url in (os.getenv("CRAWL_WHITELIST") or "https://www.opendental.com/site/api").split(",") if url],
     "MODEL_PATH":       os.getenv("MODEL_PATH"),
     "DOWNLOADS_PATH":   os.getenv("DOWNLOADS_PATH"),
+    "CONCURRENCY":      int(os.getenv("CRAWL_CONCURRENCY") or 8),
+    "RATE_LIMIT":       float(os.getenv("CRAWL_RATE_LIMIT") or 2),
+    "RATE_BURST":       int(os.getenv("CRAWL_RATE_BURST") or 4),
+    "TIMEOUT":          float(os.getenv("CRAWL_TIMEOUT") or 10),
+    "RETRIES":          int(os.getenv("CRAWL_RETRIES") or 3),
+    "CHECKPOINT_EVERY": int(os.getenv("CRAWL_CHECKPOINT_EVERY") or 50),
+    "INCREMENTAL":      os.getenv("INCREMENTAL", "false").lower() in ("1", "true", "yes"),
+    "CLEAN_WORKERS":    int(os.getenv("CRAWL_CLEAN_WORKERS") or os.cpu_count() or 1),
 }
 
+# Prefer the much faster lxml parser when it is installed
+try:
+    import lxml  # noqa: F401
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+REMOVED_TAGS = {"script", "style", "noscript", "nav", "aside"}
+MENU_LINKS = ["Open Dental Home", "Search"]
+VERSION_PATTERN = re.compile(r"Manual v\d+\.\d")
+
 # Create the downloads directory if it does not exist
 if not os.path.exists(config["DOWNLOADS_PATH"]):
     os.makedirs(config["DOWNLOADS_PATH"])
 
-def clean_and_save(URL, content, DOWNLOADS_PATH):
-    soup = BeautifulSoup(content, "html.parser")
+def parse_page(URL, content):
+    # Parse once and collect everything cleaning and link extraction need in a single walk of the tree
+    soup = BeautifulSoup(content, PARSER)
+    found = {"removable": [], "anchors": [], "toc": [], "menu": [], "version": [], "lists": []}
+    
+    stack = [(soup, False)]
+    while stack:
+        element, removed = stack.pop()
+        if isinstance(element, NavigableString):
+            # Strings inside elements that get removed are never cleaning targets
+            if not removed and "Table of Contents" in element:
+                found["toc"].append(element)
+            if not removed and VERSION_PATTERN.search(element):
+                found["version"].append(element)
+            continue
+        if not isinstance(element, Tag):
+            continue
+        
+        if element.name in REMOVED_TAGS and not removed:
+            found["removable"].append(element)
+            removed = True
+        if element.name == "a":
+            # Links are taken from the whole page, navigation included
+            if element.get("href"):
+                found["anchors"].append(element["href"])
+            if not removed and element.string and element.string.strip() in MENU_LINKS:
+                found["menu"].append(element)
+        if element.name in ("ul", "ol") and not removed:
+            found["lists"].append(element)
+        
+        # Push children in reverse so they pop in document order
+        stack.extend((child, removed) for child in reversed(element.contents))
+    
+    return soup, found
+
+
+def clean_and_save(URL, content, DOWNLOADS_PATH, BASE_URL=None):
+    # Relative links resolve against BASE_URL, the URL the page was actually served from after redirects
+    soup, found = parse_page(URL, content)
+    BASE_URL = BASE_URL or URL
+    links = [canonicalize_url(link if urlparse(link).scheme else urljoin(BASE_URL, link)) for link in found["anchors"]]
 
     # Remove unwanted elements: script, style, noscript, nav, and aside
-    for tag in soup.find_all(["script", "style", "noscript", "nav", "aside"]):
+    for tag in found["removable"]:
         tag.decompose()
 
     # Remove table-of-contents cell or div if present in subpages
-    toc_text = soup.find(string=lambda x: x and "Table of Contents" in x)
+    toc_text = found["toc"][0] if found["toc"] else None
     if toc_text:
-        parsed = urlparse(url)
+        parsed = urlparse(URL)
         page_name = parsed.path.rstrip('/').split('/')[-1] or "index"
         if page_name.lower() not in ("index", "manual"): 
             parent = toc_text.find_parent(["div", "td"])
@@ -42,8 +104,8 @@ def clean_and_save(URL, content, DOWNLOADS_PATH):
                 toc_text.extract()
 
     # Remove top menu links like "Open Dental Home", "Search", and version selector if they remain
-    for link_text in ["Open Dental Home", "Search"]:
-        link = soup.find('a', string=lambda x: x and x.strip() == link_text)
+    for link_text in MENU_LINKS:
+        link = next((a for a in found["menu"] if not a.decomposed and a.string and a.string.strip() == link_text), None)
         if link:
             link_parent = link.parent
             link.decompose()
@@ -51,7 +113,7 @@ def clean_and_save(URL, content, DOWNLOADS_PATH):
                 link_parent.decompose()
                 
     # Remove version list (e.g., "Manual v24.4 +v24.3 ...") if present
-    version_line = soup.find(string=re.compile(r"Manual v\d+\.\d"))
+    version_line = next((line for line in found["version"] if not line.decomposed and line.parent is not None), None)
     if version_line:
         parent = version_line.parent
         if parent:
@@ -60,13 +122,12 @@ def clean_and_save(URL, content, DOWNLOADS_PATH):
             version_line.extract()
 
     # Add bullet markers for list items to preserve list structure in text
-    for ul in soup.find_all("ul"):
-        for li in ul.find_all("li", recursive=False):
-            li.insert(0, "- ")
-    for ol in soup.find_all("ol"):
+    for lst in found["lists"]:
+        if lst.decomposed:
+            continue
         num = 1
-        for li in ol.find_all("li", recursive=False):
-            li.insert(0, f"{num}. ")
+        for li in lst.find_all("li", recursive=False):
+            li.insert(0, "- " if lst.name == "ul" else f"{num}. ")
             num += 1
 
     # Extract text
@@ -85,15 +146,125 @@ def clean_and_save(URL, content, DOWNLOADS_PATH):
     cleaned_text = re.sub(r"\n{3,}", "\n\n", cleaned_text).strip()
 
     # Save the cleaned text to a file
-    file_name = URL.split("/")[-1].split(".")[0]
+    # Directory pages (".../guide/") are named after their last path segment
+    file_name = URL.rstrip("/").split("/")[-1].split(".")[0] or "index"
     page_name = cleaned_text.split("\n")[0].replace(",", "")
     output_path = os.path.join(DOWNLOADS_PATH, file_name)
+    content_hash = hashlib.sha256(cleaned_text.encode("utf-8")).hexdigest()
     
-    # Save the cleaned text to a file, create if it does not exist
-    with open(f"{output_path}", "w", encoding="utf-8") as f:
-        f.write(cleaned_text)
+    # Save the cleaned text to a file, create if it does not exist and skip the write if nothing changed
+    if read_text(output_path) != cleaned_text:
+        with open(f"{output_path}", "w", encoding="utf-8") as f:
+            f.write(cleaned_text)
     
-    return file_name, page_name
+    return file_name, page_name, content_hash, links
+
+
+def read_text(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def canonicalize_url(url):
+    # Drop fragments and default ports, and sort query parameters so one page has one URL. The trailing
+    # slash stays, "docs/guide/" and "docs/guide" resolve relative links differently
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    path = parsed.path or "/"
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((scheme, netloc, path, parsed.params, query, ""))
+
+
+def load_checkpoint(checkpoint_path, START_URL):
+    # The checkpoint is a log, one JSON record per checkpoint holding what changed since the previous
+    # one: newly queued (url, depth) pairs, newly visited URLs, new index rows and new cache entries.
+    # Replaying it rebuilds the crawl state, and the frontier is every queued URL not visited yet.
+    if not os.path.exists(checkpoint_path):
+        return None
+    records = []
+    valid_size = 0
+    with open(checkpoint_path, "rb") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line.decode("utf-8")))
+            except ValueError:
+                break
+            valid_size += len(line)
+    
+    # A checkpoint from a different crawl can't be resumed
+    if not records or records[0].get("start_url") != START_URL:
+        return None
+    
+    # Drop a record cut short by a crash so the next checkpoint appends after the last complete one
+    if valid_size < os.path.getsize(checkpoint_path):
+        with open(checkpoint_path, "r+b") as f:
+            f.truncate(valid_size)
+    
+    queued = []
+    state = {"visited": set(), "table": [], "cache": {}}
+    for record in records:
+        queued.extend(record.get("queued", []))
+        state["visited"].update(record.get("visited", []))
+        state["table"].extend(record.get("rows", []))
+        state["cache"].update(record.get("cache", {}))
+    state["seen"] = {url for url, _ in queued}
+    state["queue"] = [(url, depth) for url, depth in queued if url not in state["visited"]]
+    return state
+
+
+def append_checkpoint(checkpoint_path, record, mode="a"):
+    # Appending only the changes keeps every checkpoint as cheap as the pages it covers
+    with open(checkpoint_path, mode, encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_json(path, data):
+    # Write to a temp file and swap it in, a crash mid-write keeps the previous file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_csv_index(output_dir):
+    csv_path = os.path.join(output_dir, "data.csv")
+    if not os.path.exists(csv_path):
+        return []
+    with open(csv_path, "r", encoding="utf-8") as f:
+        return [line.strip().split(",") for line in f if line.strip()]
+
+
+def load_http_cache(output_dir):
+    # Validators, links and index row of every page from the last crawl, keyed by URL
+    cache_path = os.path.join(output_dir, "http_cache.json")
+    if not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_http_cache(output_dir, http_cache):
+    save_json(os.path.join(output_dir, "http_cache.json"), http_cache)
+
+
+def conditional_headers(entry):
+    # Only ask for a 304 when the cleaned file from last time is still on disk
+    if not entry or not os.path.exists(entry["path"]):
+        return None
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers or None
+
 
 def save_csv_index(data, output_dir):
     if not os.path.exists(output_dir):
@@ -108,7 +279,10 @@ def crawl(START_URL=config["START_URL"],
           MAX_DEPTH=config["MAX_DEPTH"], 
           BLACKLIST=config["BLACKLIST"], 
           WHITELIST=config["WHITELIST"], 
-          DOWNLOADS_PATH=config["DOWNLOADS_PATH"]):
+          DOWNLOADS_PATH=config["DOWNLOADS_PATH"],
+          CONCURRENCY=config["CONCURRENCY"],
+          RATE_LIMIT=config["RATE_LIMIT"],
+          INCREMENTAL=config["INCREMENTAL"]):
     
     file_id = 0
     file_page_path_url_table = []
@@ -118,8 +292,20 @@ def crawl(START_URL=config["START_URL"],
     if WHITELIST is None:
         WHITELIST = []
         
+    START_URL = canonicalize_url(START_URL)
+    checkpoint_path = os.path.join(DOWNLOADS_PATH, "crawl_state.jsonl")
+        
+    # Frontier of (url, depth), every URL ever enqueued is in seen so each is only queued once
     visited = set()
-    queue = [] 
+    seen = set()
+    queue = deque()
+    
+    # Queued and visited URLs and cache entries since the last checkpoint, the next one appends them
+    pending = {"queued": [], "visited": [], "cache": [], "rows": 0}
+    
+    # Validators from the last crawl for conditional GETs, and the ones collected by this crawl
+    previous_cache = load_http_cache(DOWNLOADS_PATH) if INCREMENTAL else {}
+    http_cache = {}
 
     # Helper to check if a URL should be crawled
     def is_valid_link(link):
@@ -130,7 +316,7 @@ def crawl(START_URL=config["START_URL"],
         full_url = link if parsed.scheme else urljoin(base_url, link)
         
         # Always allow the starting URL, we start crawling from here
-        if full_url == config["START_URL"]:
+        if full_url == START_URL:
             return True
         
         if WHITELIST:
@@ -161,61 +347,186 @@ def crawl(START_URL=config["START_URL"],
     if not base_url.endswith("/"):
         base_url = base_url.rsplit("/", 1)[0] + "/"
 
+    session = create_session(CONCURRENCY)
+    limiter = HostRateLimiter(RATE_LIMIT, config["RATE_BURST"])
+
+    def fetch_page(url):
+        headers = conditional_headers(previous_cache.get(url))
+        with metrics.timer("crawl.fetch"):
+            return fetch(session, url, limiter, timeout=config["TIMEOUT"], retries=config["RETRIES"], headers=headers)
+
+    def checkpoint():
+        append_checkpoint(checkpoint_path, {
+            "queued":  pending["queued"],
+            "visited": pending["visited"],
+            "rows":    file_page_path_url_table[pending["rows"]:],
+            "cache":   {url: http_cache[url] for url in pending["cache"]},
+        })
+        pending.update({"queued": [], "visited": [], "cache": [], "rows": len(file_page_path_url_table)})
+
+    def mark_visited(url):
+        visited.add(url)
+        pending["visited"].append(url)
+
+    def reuse_previous(url, curr_depth):
+        # Keep last crawl's file, row, cache entry and links for the page, False if there are none
+        entry = previous_cache.get(url)
+        if not entry or not os.path.exists(entry["path"]):
+            return False
+        mark_visited(url)
+        http_cache[url] = entry
+        pending["cache"].append(url)
+        file_page_path_url_table.append([entry["file_name"], entry["page_name"], entry["path"], url, entry["content_hash"]])
+        enqueue_links(entry["links"], curr_depth)
+        return True
+
+    def enqueue_links(links, curr_depth):
+        for full_link in links:
+            # Check if valid link and has not been queued before
+            if (full_link not in seen) and (is_valid_link(full_link)) and (full_link.startswith(base_url)):
+                queue.append((full_link, curr_depth + 1))
+                seen.add(full_link)
+                pending["queued"].append((full_link, curr_depth + 1))
+
     def crawl_bfs(url):
         nonlocal file_id
         
-        # Enqueue the URL with depth 0
-        queue.append((url, 0))
+        # Resume an interrupted crawl, otherwise enqueue the URL with depth 0
+        state = load_checkpoint(checkpoint_path, url)
+        if state:
+            queue.extend((link, depth) for link, depth in state["queue"])
+            seen.update(state["seen"])
+            visited.update(state["visited"])
+            file_page_path_url_table.extend(state["table"])
+            http_cache.update(state.get("cache", {}))
+            file_id = len(file_page_path_url_table)
+            pending["rows"] = file_id
+            print(f"Resuming crawl with {len(visited)} pages done and {len(queue)} queued...")
+        else:
+            queue.append((url, 0))
+            seen.add(url)
+            # A fresh log starts with the crawl it belongs to
+            append_checkpoint(checkpoint_path, {"start_url": START_URL, "queued": [(url, 0)]}, mode="w")
         
-        while queue:
-            current_url, curr_depth = queue.pop(0)
-            
-            # Skip if max depth reached or URL already visited
-            if curr_depth > MAX_DEPTH or current_url in visited:
-                continue
-            
-            total = len(queue) + len(visited)
-            print(f"{len(visited)}/{total} | Scraping: \"{current_url}\"...")
-            
-            # Try to fetch the page content
-            try:
-                response = requests.get(current_url)
-            except Exception as e:
-                continue
-            
-            content_type = response.headers.get("Content-Type", "")
-            
-            # Skip if not HTML content
-            if "text/html" not in content_type:
-                continue
-            
-            # Mark URL as visited
-            visited.add(current_url)
-            
-            # Save the page content to a file
-            html_content = response.text
-            
-            # Save 
-            file_name, page_name = clean_and_save(current_url, html_content, DOWNLOADS_PATH)
-            path = f"{DOWNLOADS_PATH}/{file_name}"
-            file_page_path_url_table.append([file_name, page_name, path, current_url])
-            file_id += 1
-            
-            # Parse and enqueue links
-            soup = BeautifulSoup(html_content, "html.parser")
-            for a in soup.find_all('a', href=True):
-                link = a['href']
-                full_link = link if urlparse(link).scheme else urljoin(current_url, link)
+        last_checkpoint = len(visited)
+        
+        # Rolling window of pages in flight, fetched or being cleaned, refilled from the queue as each
+        # one completes so a slow page never holds up the others. The rate limiter paces the requests.
+        fetching = {}
+        cleaning = {}
+        in_flight = set()
+        
+        def fill_window():
+            while queue and len(fetching) + len(cleaning) < CONCURRENCY * 4:
+                current_url, curr_depth = queue.popleft()
                 
-                # Check if valid link and is not already in the queue
-                if (is_valid_link(full_link)) and (full_link not in (item[0] for item in queue)) and (full_link.startswith(base_url)):
-                    queue.append((full_link, curr_depth + 1))
+                # Skip if max depth reached or URL already visited
+                if curr_depth > MAX_DEPTH or current_url in visited or current_url in in_flight:
+                    continue
+                in_flight.add(current_url)
+                fetching[executor.submit(fetch_page, current_url)] = (current_url, curr_depth)
+        
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor, \
+             ProcessPoolExecutor(max_workers=config["CLEAN_WORKERS"]) as cleaner:
+            fill_window()
+            while fetching or cleaning:
+                done, _ = wait([*fetching, *cleaning], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in cleaning:
+                        current_url, curr_depth, response = cleaning.pop(future)
+                        in_flight.discard(current_url)
+                        file_name, page_name, content_hash, links = future.result()
+                        metrics.count("crawl.pages_saved")
+                        path = f"{DOWNLOADS_PATH}/{file_name}"
+                        
+                        # Only a page with its row is visited, so a checkpoint never drops one still in flight
+                        mark_visited(current_url)
+                        file_page_path_url_table.append([file_name, page_name, path, current_url, content_hash])
+                        file_id += 1
+                        
+                        # Enqueue the links found while cleaning
+                        enqueue_links(links, curr_depth)
+                        
+                        http_cache[current_url] = {
+                            "etag":          response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                            "file_name":     file_name,
+                            "page_name":     page_name,
+                            "path":          path,
+                            "content_hash":  content_hash,
+                            "links":         links,
+                        }
+                        pending["cache"].append(current_url)
+                        continue
+                    
+                    current_url, curr_depth = fetching.pop(future)
+                    in_flight.discard(current_url)
+                    
+                    total = len(queue) + len(visited) + len(in_flight) + 1
+                    print(f"{len(visited)}/{total} | Scraping: \"{current_url}\"...")
+                    
+                    # Try to fetch the page content, anything but a 2xx or a 304 counts as a failed fetch,
+                    # including the error statuses left after the fetcher's retries
+                    try:
+                        response = future.result()
+                        failure = None if 200 <= response.status_code < 300 or response.status_code == 304 else f"HTTP {response.status_code}"
+                    except Exception as e:
+                        response, failure = None, str(e) or type(e).__name__
+                    if response is not None:
+                        metrics.count("crawl.responses")
+                        metrics.count("crawl.bytes", len(response.content))
+                    
+                    # A failed fetch never replaces the page, whatever was saved for it last time is kept
+                    if failure:
+                        metrics.count("crawl.errors")
+                        print(f"Failed to fetch \"{current_url}\": {failure}")
+                        if reuse_previous(current_url, curr_depth):
+                            file_id += 1
+                        continue
                     
-            # Sleep after each page to avoid hammering the server
-            time.sleep(random.uniform(0.5,1))
+                    # Unchanged since the last crawl, reuse the saved file, its row and its links
+                    if response.status_code == 304 and reuse_previous(current_url, curr_depth):
+                        metrics.count("crawl.not_modified")
+                        file_id += 1
+                        continue
+                    
+                    content_type = response.headers.get("Content-Type", "")
+                    
+                    # Skip if not HTML content
+                    if "text/html" not in content_type:
+                        continue
+                    
+                    # Clean and save the page in the process pool while other fetches run
+                    in_flight.add(current_url)
+                    cleaning[cleaner.submit(clean_and_save, current_url, response.text, DOWNLOADS_PATH, response.url)] = (current_url, curr_depth, response)
+                
+                fill_window()
+                
+                # Pages still in flight aren't visited yet, a resumed crawl fetches them again
+                if len(visited) - last_checkpoint >= config["CHECKPOINT_EVERY"]:
+                    checkpoint()
+                    last_checkpoint = len(visited)
 
-    crawl_bfs(START_URL)
-    save_csv_index(file_page_path_url_table, DOWNLOADS_PATH)
+    try:
+        with metrics.timer("crawl.bfs"):
+            crawl_bfs(START_URL)
+    finally:
+        session.close()
+    
+    # Record what changed since the last crawl for the processor and uploader. A change set that was
+    # never published (the processor or upload failed or didn't run) is merged in, not overwritten.
+    with metrics.timer("crawl.save_index"):
+        changes = diff_index(read_csv_index(DOWNLOADS_PATH), file_page_path_url_table)
+        pending = load_changes(DOWNLOADS_PATH)
+        if pending is not None:
+            changes = merge_changes(pending, changes, {row[0] for row in file_page_path_url_table})
+        save_changes(DOWNLOADS_PATH, changes)
+        save_csv_index(file_page_path_url_table, DOWNLOADS_PATH)
+        save_http_cache(DOWNLOADS_PATH, http_cache)
+    
+    # The crawl finished, the next one starts fresh
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
 
 def main():
@@ -0,0 +1,72 @@
+import re
+import zlib
+import numpy as np
+
+# Near-duplicate detection with MinHash signatures and an LSH band index. Every document becomes the
+# set of its word shingles, the share of equal MinHash values between two signatures estimates the
+# Jaccard similarity of those sets, and banding the signatures only compares documents that collide
+# in at least one band, so finding duplicates stays close to linear in the number of documents.
+NUM_PERM = 128
+SHINGLE_SIZE = 5
+WORD = re.compile(r"\w+")
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    # Stable 32-bit hashes of the word `size`-grams, texts shorter than that are a single shingle
+    words = WORD.findall(text.lower())
+    grams = {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    def __init__(self, num_perm=NUM_PERM, seed=0):
+        # Multiply-shift hash family, the top 32 bits of a * x + b with 64-bit wraparound
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 2**63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        hashes = shingles(text)
+        with np.errstate(over="ignore"):
+            values = (self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(32)
+        return values.min(axis=1).astype(np.uint32)
+
+
+def lsh_params(threshold, num_perm=NUM_PERM):
+    # Bands and rows per band whose S-curve midpoint (1 / bands) ** (1 / rows) is closest to threshold
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+def find_duplicates(signatures, threshold):
+    # Groups of near-duplicate documents as lists of row indexes, lowest index first, singletons left out
+    signatures = np.asarray(signatures)
+    bands, rows = lsh_params(threshold, signatures.shape[1])
+    parent = list(range(len(signatures)))
+
+    def find(idx):
+        while parent[idx] != idx:
+            parent[idx] = parent[parent[idx]]
+            idx = parent[idx]
+        return idx
+
+    for band in range(bands):
+        buckets = {}
+        for idx, key in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets.setdefault(key.tobytes(), []).append(idx)
+        for members in buckets.values():
+            # Candidates only join a group when their estimated similarity clears the threshold
+            for other in members[1:]:
+                first, second = find(members[0]), find(other)
+                if first != second and np.mean(signatures[members[0]] == signatures[other]) >= threshold:
+                    parent[max(first, second)] = min(first, second)
+
+    groups = {}
+    for idx in range(len(signatures)):
+        groups.setdefault(find(idx), []).append(idx)
+    return [members for members in groups.values() if len(members) > 1]
@@ -0,0 +1,74 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+# Status codes worth another attempt, everything else is returned to the caller as is. The last
+# response is returned when the retries run out, callers check the status before using the body.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    # Allows `rate` requests per second on average with bursts of up to `burst` requests
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    # One token bucket per host so a slow site doesn't throttle the others
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url):
+        if not self.rate or self.rate <= 0:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate, self.burst)
+        bucket.acquire()
+
+
+def create_session(pool_size):
+    # Shared keep-alive connection pool sized for the number of concurrent workers
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch(session, url, limiter, timeout=10, retries=3, backoff=0.5, headers=None):
+    # GET with a per-host rate limit, retrying connection errors and retryable statuses with exponential backoff
+    for attempt in range(retries + 1):
+        limiter.acquire(url)
+        try:
+            response = session.get(url, timeout=timeout, headers=headers)
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+        time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
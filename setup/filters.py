@@ -0,0 +1,100 @@
+import bisect
+import re
+from urllib.parse import urlsplit
+import numpy as np
+from bundle import load_array
+from query_model import decode_strings, encode_strings
+
+# Metadata filters, resolved to document row ids before anything is scored. For every field the
+# processor writes two bundle arrays:
+#   filter_<field>_keys  the field's values in sorted order, newline separated UTF-8
+#   filter_<field>_ids   int32 row id of every sorted value
+# An exact value or a prefix is one contiguous range of the sorted values, found with two binary
+# searches, so a predicate costs O(log n) plus the rows it matches. Predicates are written
+#   field=value      exact match
+#   field^=prefix    prefix match
+# with field one of FIELDS, url_path being the path part of the url (e.g. url_path^=/site/api/).
+# Several predicates must all match.
+FIELDS = ("url", "url_path", "page_name", "file_name")
+PREDICATE = re.compile(r"(\w+)(\^?=)(.*)$", re.S)
+RESOLVED_CACHE_SIZE = 256
+
+
+def keys_name(field):
+    return f"filter_{field}_keys"
+
+
+def ids_name(field):
+    return f"filter_{field}_ids"
+
+
+def field_value(document, field):
+    if field == "url_path":
+        return urlsplit(document["url"]).path
+    return document[field]
+
+
+def filter_arrays(documents):
+    # documents are manifest document records, see bundle.document_record
+    arrays = {}
+    for field in FIELDS:
+        values = [field_value(document, field) for document in documents]
+        order = sorted(range(len(values)), key=values.__getitem__)
+        arrays[keys_name(field)] = encode_strings(values[idx] for idx in order)
+        arrays[ids_name(field)] = np.array(order, dtype=np.int32)
+    return arrays
+
+
+def build_filters(bundle, documents):
+    for name, array in filter_arrays(documents).items():
+        bundle.add_array(name, array)
+
+
+def parse_filters(filters):
+    # Predicate strings -> sorted tuple of (field, op, value), hashable so it can be part of a cache key
+    parsed = set()
+    for predicate in filters or ():
+        match = PREDICATE.match(predicate)
+        if not match or match.group(1) not in FIELDS:
+            raise ValueError(f"Invalid filter {predicate!r}, expected FIELD=VALUE or FIELD^=PREFIX "
+                             f"with FIELD one of {', '.join(FIELDS)}")
+        parsed.add(match.groups())
+    return tuple(sorted(parsed))
+
+
+class FilterIndex:
+    def __init__(self, keys, ids):
+        self.keys = keys
+        self.ids = ids
+        self.resolved = {}
+
+    def matches(self, field, op, value):
+        keys = self.keys[field]
+        start = bisect.bisect_left(keys, value)
+        # Every string starting with the prefix sorts before prefix + the highest code point
+        end = bisect.bisect_right(keys, value) if op == "=" else bisect.bisect_left(keys, value + "\U0010ffff", start)
+        return self.ids[field][start:end]
+
+    def resolve(self, filters):
+        # Ascending row ids matching every predicate, so rows are read from the matrix in file order
+        rows = self.resolved.get(filters)
+        if rows is not None:
+            return rows
+        for predicate in filters:
+            matched = np.sort(self.matches(*predicate))
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        if len(self.resolved) >= RESOLVED_CACHE_SIZE:
+            self.resolved.clear()
+        self.resolved[filters] = rows
+        return rows
+
+
+def load_filters(index_path, manifest):
+    # Bundles built before the filter arrays sort the manifest documents on load instead
+    arrays = {name: load_array(index_path, manifest, name) for field in FIELDS for name in (keys_name(field), ids_name(field))}
+    if any(array is None for array in arrays.values()):
+        arrays = filter_arrays(manifest["documents"])
+    # A single empty value encodes to nothing, hence the padding
+    ids = {field: np.asarray(arrays[ids_name(field)]) for field in FIELDS}
+    keys = {field: decode_strings(arrays[keys_name(field)]) or [""] * len(ids[field]) for field in FIELDS}
+    return FilterIndex(keys, ids)
@@ -0,0 +1,190 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# resource (peak RSS) only exists on Unix, memory samples are left out elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+load_dotenv()
+
+# Stage timers, counters and peak memory for the pipeline and the query path. Off unless METRICS
+# is "json" (one JSON line per metric, appended to METRICS_PATH or written to stderr) or
+# "prometheus" (a text file in the node_exporter textfile format, METRICS_PATH or metrics.prom in
+# DOWNLOADS_PATH). Disabled timers and counters cost a function call and nothing else.
+config = {
+    "METRICS":        os.getenv("METRICS", "").lower(),
+    "METRICS_PATH":   os.getenv("METRICS_PATH"),
+    "DOWNLOADS_PATH": os.getenv("DOWNLOADS_PATH"),
+}
+
+FORMATS = ("json", "prometheus")
+
+state = {
+    "format":   None,
+    "path":     None,
+    "process":  None,
+    "timers":   {},
+    "counters": {},
+    "flushed":  False,
+}
+lock = threading.Lock()
+
+
+def configure(format=None, path=None, process=None):
+    # Called by every entry point, a --metrics flag overrides METRICS. Metrics are written on exit.
+    format = (format or config["METRICS"] or "").lower()
+    if not format or format in ("0", "false", "no", "off"):
+        return
+    if format in ("1", "true", "yes", "on"):
+        format = "json"
+    if format not in FORMATS:
+        raise ValueError(f"Unknown metrics format {format!r}, expected one of {', '.join(FORMATS)}")
+
+    # Pool workers import the pipeline modules too, only the parent process reports
+    multiprocessing = sys.modules.get("multiprocessing")
+    if multiprocessing is not None and multiprocessing.parent_process() is not None:
+        return
+
+    first = state["format"] is None
+    state["format"] = format
+    state["path"] = path or config["METRICS_PATH"]
+    state["process"] = process or state["process"] or os.path.basename(sys.argv[0]).rsplit(".", 1)[0]
+    if os.getenv("SHARD") and not state["process"].endswith(f":{os.getenv('SHARD')}"):
+        state["process"] += f":{os.getenv('SHARD')}"
+    if first:
+        atexit.register(flush)
+
+
+def enabled():
+    return state["format"] is not None
+
+
+def peak_rss():
+    # Peak resident set size of this process in bytes, ru_maxrss is in KB on Linux and bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextmanager
+def timer(name):
+    if state["format"] is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name, seconds):
+    # For stages that time themselves
+    if state["format"] is None:
+        return
+    peak = peak_rss()
+    with lock:
+        entry = state["timers"].setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_rss": None})
+        entry["count"] += 1
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+        entry["peak_rss"] = peak
+
+
+def count(name, value=1):
+    if state["format"] is None:
+        return
+    with lock:
+        state["counters"][name] = state["counters"].get(name, 0) + value
+
+
+def records():
+    timestamp = time.time()
+    process = state["process"]
+    for name, entry in sorted(state["timers"].items()):
+        yield {"time": timestamp, "process": process, "type": "timer", "name": name, **entry}
+    for name, value in sorted(state["counters"].items()):
+        yield {"time": timestamp, "process": process, "type": "counter", "name": name, "value": value}
+    peak = peak_rss()
+    if peak is not None:
+        yield {"time": timestamp, "process": process, "type": "gauge", "name": "peak_rss", "value": peak}
+
+
+def metric_name(name):
+    return "docchat_" + "".join(ch if ch.isalnum() else "_" for ch in name)
+
+
+def prometheus_text():
+    labels = f'process="{state["process"]}"'
+    lines = []
+    for record in records():
+        if record["type"] == "timer":
+            stage = f'{labels},stage="{record["name"]}"'
+            lines.append(f"docchat_stage_seconds_total{{{stage}}} {record['seconds']:.6f}")
+            lines.append(f"docchat_stage_max_seconds{{{stage}}} {record['max_seconds']:.6f}")
+            lines.append(f"docchat_stage_calls_total{{{stage}}} {record['count']}")
+        elif record["type"] == "counter":
+            lines.append(f"{metric_name(record['name'])}_total{{{labels}}} {record['value']}")
+        else:
+            lines.append(f"docchat_peak_rss_bytes{{{labels}}} {record['value']}")
+
+    # Group samples by metric with one TYPE line each, as the text format expects
+    families = {}
+    for line in lines:
+        families.setdefault(line.split("{", 1)[0], []).append(line)
+    text = []
+    for family, samples in families.items():
+        text.append(f"# TYPE {family} {'gauge' if family.endswith(('_max_seconds', '_bytes')) else 'counter'}")
+        text.extend(samples)
+    return "\n".join(text) + "\n"
+
+
+def flush():
+    with lock:
+        # Nothing is written for runs that recorded nothing, like setup.py handing shards to child processes
+        if state["format"] is None or state["flushed"] or not (state["timers"] or state["counters"]):
+            return
+        state["flushed"] = True
+        if state["format"] == "prometheus":
+            path = state["path"] or os.path.join(config["DOWNLOADS_PATH"] or ".", "metrics.prom")
+            # Written under a temporary name and renamed, so a scraper never reads half a file
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(prometheus_text())
+            os.replace(path + ".tmp", path)
+        else:
+            lines = "".join(json.dumps(record) + "\n" for record in records())
+            if state["path"]:
+                with open(state["path"], "a", encoding="utf-8") as f:
+                    f.write(lines)
+            else:
+                sys.stderr.write(lines)
+
+
+@contextmanager
+def profile(path):
+    # cProfile the block and dump the stats to path, read them with `python -m pstats <path>`
+    if not path:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Profile written to {path}", file=sys.stderr)
+
+
+# Configured from METRICS on import, entry points call configure() again for a --metrics flag
+configure()
@@ -0,0 +1,94 @@
+import re
+import numpy as np
+
+# Passage index: each cleaned document is split into overlapping passages along line and list
+# item boundaries, and each passage is stored as a byte range into the saved file so callers can read
+# just that slice. Offsets are taken from the raw bytes, they stay valid for CRLF files on Windows.
+PASSAGES = "passage_vectors"
+PASSAGE_DOCS = "passage_docs"
+PASSAGE_RANGES = "passage_ranges"
+# clean_and_save puts the list marker on its own line, followed by the item text
+LIST_MARKER = re.compile(rb"(-|\d+\.)(\s|$)")
+
+
+def read_blocks(raw):
+    # Blocks of (start, end) unit ranges. A run of list items is one block with one unit per item
+    # (marker line plus the line after it), every other line is a block of its own.
+    blocks = []
+    in_list = False
+    item_open = False
+    start = 0
+    for line in raw.split(b"\n"):
+        end = start + len(line)
+        stripped = line.rstrip(b"\r")
+        if stripped.strip():
+            line_range = (start, start + len(stripped))
+            if LIST_MARKER.match(stripped):
+                if in_list:
+                    blocks[-1].append(line_range)
+                else:
+                    blocks.append([line_range])
+                in_list = True
+                item_open = LIST_MARKER.fullmatch(stripped.rstrip()) is not None
+            elif item_open:
+                # Item text joins the marker line before it
+                blocks[-1][-1] = (blocks[-1][-1][0], line_range[1])
+                item_open = False
+            else:
+                blocks.append([line_range])
+                in_list = False
+        start = end + 1
+    return blocks
+
+
+def split_passages(raw, size, overlap):
+    # Lists that don't fit in one passage are split back into their items
+    units = []
+    for block in read_blocks(raw):
+        if block[-1][1] - block[0][0] <= size:
+            units.append((block[0][0], block[-1][1]))
+        else:
+            units.extend(block)
+
+    passages = []
+    first = 0
+    while first < len(units):
+        # Pack whole units until the next one would overflow, a single oversized unit is kept as is
+        last = first
+        while last + 1 < len(units) and units[last + 1][1] - units[first][0] <= size:
+            last += 1
+        passages.append((units[first][0], units[last][1]))
+        if last + 1 >= len(units):
+            break
+
+        # Start the next passage on the trailing units that fit in the overlap, as long as the
+        # passage still has room for the unit after them
+        following = last + 1
+        while (following - 1 > first and units[last][1] - units[following - 1][0] <= overlap
+               and units[last + 1][1] - units[following - 1][0] <= size):
+            following -= 1
+        first = following
+    return passages
+
+
+def select_passages(ids, scores, docs, ranges, k):
+    # Overlapping passages of one document score alike, keep the best and skip the rest
+    picked = []
+    for position, idx in enumerate(ids):
+        start, end = ranges[idx]
+        if any(docs[ids[other]] == docs[idx] and ranges[ids[other]][0] < end and start < ranges[ids[other]][1]
+               for other in picked):
+            continue
+        picked.append(position)
+        if len(picked) == k:
+            break
+    picked = np.array(picked, dtype=np.intp)
+    return ids[picked], scores[picked]
+
+
+def passage_rows(docs, rows):
+    # Passage ids of the given documents (ascending ids), passages are stored grouped by document in order
+    starts = np.searchsorted(docs, rows, side="left")
+    counts = np.searchsorted(docs, rows, side="right") - starts
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return offsets + np.arange(counts.sum())
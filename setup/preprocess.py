@@ -0,0 +1,164 @@
+import re
+from itertools import islice
+import stemmer
+
+# Shared by the processor and the query path so documents and queries get identical tokens.
+# Bump PREPROCESS_VERSION whenever the output changes, it invalidates the token cache and the
+# stem map exported for FastPreprocessor.
+PREPROCESS_VERSION = 1
+TOKEN_PATTERN = re.compile(r'[^\W\d]*$')
+MAX_CACHE_SIZE = 1000000
+
+# Whitespace separated chunks word_tokenize provably splits into one word plus punctuation tokens
+# that get filtered out anyway: optional opening brackets or quote, the word, an optional clitic
+# and closing punctuation. Hyphenated words stay one token that TOKEN_PATTERN drops. A period is
+# only safe at the very end of the text, anywhere else punkt may treat it as part of an abbreviation.
+SIMPLE_CHUNK = re.compile(r'[(\[{<"]*((?:\w+-)*\w+?)(n\'t|N\'T|\'[sSmMdD]|\'ll|\'LL|\'re|\'RE|\'ve|\'VE)?[)\]}>",;:!?]*')
+PUNCTUATION_CHUNK = re.compile(r'[(\[{<")\]}>",;:!?]+')
+FINAL_PERIOD = re.compile(r'\.[)\]}>"\']*$')
+WORD = re.compile(r'\w+')
+DIGIT = re.compile(r'\d')
+
+# Words word_tokenize splits in two (MacIntyre contractions), left to NLTK
+SPLIT_WORDS = {"cannot", "gimme", "gonna", "gotta", "lemme", "wanna"}
+
+
+class Preprocessor:
+    def __init__(self):
+        # NLTK takes over a second to import, only pay for it once a preprocessor is needed
+        from nltk.tokenize import word_tokenize
+        from nltk.corpus import stopwords
+        from nltk.stem.porter import PorterStemmer
+
+        self.word_tokenize = word_tokenize
+        self.stop_words = set(stopwords.words('english'))
+        self.stemmer = PorterStemmer()
+
+        # Lowered token -> final token, or None when the token gets filtered out
+        self.cache = {}
+
+    def transform(self, lowered):
+        if lowered in self.stop_words:
+            return None
+        stemmed = self.stemmer.stem(lowered)
+        nummed = 'num' if stemmed.isdigit() else stemmed
+        return nummed if TOKEN_PATTERN.match(nummed) else None
+
+    def process(self, text):
+        cache = self.cache
+        tokens = []
+        for token in self.word_tokenize(text):
+            lowered = token.lower()
+            try:
+                result = cache[lowered]
+            except KeyError:
+                # Vocabulary repeats heavily, so each distinct token is only stemmed once
+                if len(cache) >= MAX_CACHE_SIZE:
+                    cache.clear()
+                result = cache[lowered] = self.transform(lowered)
+            if result is not None:
+                tokens.append(result)
+        return tokens
+
+
+preprocessor = None
+
+
+def get_preprocessor():
+    global preprocessor
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+    return preprocessor
+
+
+def process_text(text):
+    return get_preprocessor().process(text)
+
+
+def process_stream(items, workers=1, chunk_size=256):
+    # Tokenize (key, text) pairs in parallel chunks, yielding (key, tokens) with only one chunk of text in memory.
+    # Every worker keeps its own stopwords, stemmer and cache.
+    from multiprocessing import Pool
+
+    items = iter(items)
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                break
+            keys = [key for key, _ in chunk]
+            texts = [text for _, text in chunk]
+            if pool is not None and len(texts) > 1:
+                tokens = pool.map(process_text, texts, chunksize=max(1, len(texts) // (workers * 4)))
+            else:
+                tokens = [process_text(text) for text in texts]
+            yield from zip(keys, tokens)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def build_stem_map(texts):
+    # Final token of every distinct word in the texts, computed by the real pipeline. Stopwords and
+    # words with digits are left out, FastPreprocessor decides those without a lookup.
+    preprocessor = get_preprocessor()
+    words = set()
+    for text in texts:
+        words.update(WORD.findall(text.lower()))
+    return {word: preprocessor.transform(word) for word in words
+            if word not in preprocessor.stop_words and not DIGIT.search(word)}
+
+
+class FastPreprocessor:
+    # Produces exactly what process_text does without importing NLTK for ordinary queries. Words are
+    # split with SIMPLE_CHUNK and mapped through the stem map the processor exported, words missing
+    # from it go through the ported stemmer. Text the simple rules can't vouch for goes to NLTK.
+    def __init__(self, stems, stop_words):
+        self.stems = stems
+        self.stop_words = stop_words
+        self.fallbacks = 0
+
+    def words(self, text):
+        chunks = text.split()
+        if chunks:
+            final = FINAL_PERIOD.search(chunks[-1])
+            if final:
+                chunks[-1] = chunks[-1][:final.start()]
+        words = []
+        for chunk in chunks:
+            if not chunk or PUNCTUATION_CHUNK.fullmatch(chunk):
+                continue
+            match = SIMPLE_CHUNK.fullmatch(chunk)
+            if match is None:
+                return None
+            parts = match.group(1).lower().split("-")
+            if any(part in SPLIT_WORDS for part in parts):
+                return None
+            if len(parts) == 1:
+                words.append(parts[0])
+        return words
+
+    def transform(self, lowered):
+        if lowered in self.stop_words:
+            return None
+        if DIGIT.search(lowered):
+            # Stemming only strips letter suffixes, so digits survive it
+            return 'num' if lowered.isdigit() else None
+        try:
+            return self.stems[lowered]
+        except KeyError:
+            stemmed = stemmer.stem(lowered)
+            return stemmed if TOKEN_PATTERN.match(stemmed) else None
+
+    def process(self, text):
+        words = self.words(text)
+        if words is None:
+            self.fallbacks += 1
+            return process_text(text)
+        tokens = []
+        for word in words:
+            result = self.transform(word)
+            if result is not None:
+                tokens.append(result)
+        return tokens
@@ -1,13 +1,23 @@
 import json
 import os
-import re
+import time
+from itertools import groupby
 import numpy as np
 from gensim.models import Word2Vec
-from gensim.similarities import MatrixSimilarity
-from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
-from nltk.stem.porter import PorterStemmer
 from dotenv import load_dotenv
+import preprocess
+from token_cache import TokenCache
+from vectors import encode_vector, to_text
+from bundle import BundleWriter, bundle_exists, document_record, load_bundle, read_manifest
+from changes import has_changes, load_changes, save_changes
+from dedup import NUM_PERM, MinHasher, find_duplicates
+from ann import build_ivf, recall_at_k, search_ivf
+from bm25 import build_bm25
+from quantize import PRECISIONS, build_compact, search_compact
+from query_model import export_query_model
+from filters import build_filters
+from passages import PASSAGE_DOCS, PASSAGE_RANGES, PASSAGES, split_passages
+import metrics
 
 load_dotenv()
 
@@ -17,6 +27,27 @@ config = {
     "DOWNLOADS_PATH":       os.getenv("DOWNLOADS_PATH"),
     "MODEL_PATH":           os.getenv("MODEL_PATH"),
     "WORKING_DIR":          os.getenv("WORKING_DIR"),
+    "INDEX_PATH":           os.getenv("INDEX_PATH") or os.path.join(os.getenv("DOWNLOADS_PATH", ""), "index"),
+    "ANN_INDEX":            os.getenv("ANN_INDEX", "false").lower() in ("1", "true", "yes"),
+    "ANN_LISTS":            int(os.getenv("ANN_LISTS") or 0),
+    "ANN_NPROBE":           int(os.getenv("ANN_NPROBE") or 8),
+    "VECTOR_PRECISION":     os.getenv("VECTOR_PRECISION", "float32").lower(),
+    "RERANK_DEPTH":         int(os.getenv("RERANK_DEPTH") or 100),
+    "INCREMENTAL":          os.getenv("INCREMENTAL", "false").lower() in ("1", "true", "yes"),
+    "PREPROCESS_WORKERS":   int(os.getenv("PREPROCESS_WORKERS") or os.cpu_count() or 1),
+    "TOKEN_CACHE_PATH":     os.getenv("TOKEN_CACHE_PATH") or os.path.join(os.getenv("DOWNLOADS_PATH", ""), "token_cache"),
+    "DEDUP":                os.getenv("DEDUP", "false").lower() in ("1", "true", "yes"),
+    "DEDUP_THRESHOLD":      float(os.getenv("DEDUP_THRESHOLD") or 0.9),
+    "VECTOR_SIZE":          500,
+    "TRAIN_EPOCHS":         int(os.getenv("TRAIN_EPOCHS") or 200),
+    "TRAIN_TIME_LIMIT":     float(os.getenv("TRAIN_TIME_LIMIT") or 0),
+    "TRAIN_LOSS_TOLERANCE": float(os.getenv("TRAIN_LOSS_TOLERANCE") or 0),
+    "TRAIN_PATIENCE":       int(os.getenv("TRAIN_PATIENCE") or 3),
+    "INCREMENTAL_TRAIN":    os.getenv("INCREMENTAL_TRAIN", "true").lower() in ("1", "true", "yes"),
+    "BM25_INDEX":           os.getenv("BM25_INDEX", "false").lower() in ("1", "true", "yes"),
+    "PASSAGE_INDEX":        os.getenv("PASSAGE_INDEX", "false").lower() in ("1", "true", "yes"),
+    "PASSAGE_SIZE":         int(os.getenv("PASSAGE_SIZE") or 1500),
+    "PASSAGE_OVERLAP":      int(os.getenv("PASSAGE_OVERLAP") or 200),
 }
 
 
@@ -27,50 +58,143 @@ def read_csv(file_path):
 
 
 def read_docs(csv_data):
-    document_list = []
-    for row in csv_data:
+    # Stream (index, text) pairs, only one document's text is held at a time
+    for csv_data_idx, row in enumerate(csv_data):
         file_path = row[2]
-        csv_data_idx = csv_data.index(row)
-        document_content = ""
         
         # Read the document text from the file
         with open(f"{file_path}", "r", encoding="utf-8") as f:
             document_content = f.read()
     
-        # Append tuple of document index and document text to the document list
-        idx_txt = (csv_data_idx, document_content)
-        document_list.append(idx_txt)
-            
-    return document_list
+        yield (csv_data_idx, document_content)
+
+
+def drop_duplicates(csv_data):
+    # Near-duplicate pages (print views, versioned copies) collapse into the first one crawled
+    hasher = MinHasher()
+    signatures = np.array([hasher.signature(text) for _, text in read_docs(csv_data)], dtype=np.uint32).reshape(-1, NUM_PERM)
+    groups = find_duplicates(signatures, config["DEDUP_THRESHOLD"])
+    duplicates = {csv_data[members[0]][0]: [csv_data[idx][0] for idx in members[1:]] for members in groups}
+    dropped = {idx for members in groups for idx in members[1:]}
+
+    with open(os.path.join(config["DOWNLOADS_PATH"], "duplicates.json"), "w", encoding="utf-8") as f:
+        json.dump(duplicates, f, indent=2)
+    metrics.count("processor.duplicates", len(dropped))
+    print(f"Collapsed {len(dropped)} near-duplicate documents into {len(groups)} canonical ones...")
+    return [row for idx, row in enumerate(csv_data) if idx not in dropped]
+
+
+def reconcile_changes(changes, csv_data):
+    # A page can become or stop being a duplicate without changing itself, the uploader follows the kept set
+    previous = {document["file_name"] for document in read_manifest(config["INDEX_PATH"])["documents"]}
+    kept = {row[0] for row in csv_data}
+    changes["added"] = sorted(set(changes["added"]) | (kept - previous))
+    changes["removed"] = sorted(set(changes["removed"]) | (previous - kept))
+    save_changes(config["DOWNLOADS_PATH"], changes)
 
 
 def process_text(idx_txt):
-    text = idx_txt[1]
+    return preprocess.process_text(idx_txt[1])
+
+
+class TokenCorpus:
+    # Restartable iterable over cached token lists, gensim makes one pass per epoch without the corpus in memory
+    def __init__(self, cache, keys):
+        self.cache = cache
+        self.keys = keys
+
+    def __iter__(self):
+        for key in self.keys:
+            yield self.cache.get(key)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def process_documents(document_list):
+    # Load unchanged documents from the token cache and only run NLTK over the rest, streaming both ways
+    cache = TokenCache(config["TOKEN_CACHE_PATH"], preprocess.PREPROCESS_VERSION)
+    keys = []
     
-    stop_words = set(stopwords.words('english'))
-    stemmer = PorterStemmer()
+    def misses():
+        for _, text in document_list:
+            key = cache.key(text)
+            keys.append(key)
+            if not cache.has(key):
+                yield key, text
     
-    tokens = word_tokenize(text)
-    lowered = [t.lower() for t in tokens]
-    stopped = [t for t in lowered if t not in stop_words]
-    stemmed = [stemmer.stem(t) for t in stopped]
-    nummed = ['num' if t.isdigit() else t for t in stemmed]
-    regex = [t for t in nummed if re.match(r'[^\W\d]*$', t)]
+    tokenized = 0
+    with metrics.timer("processor.tokenize"):
+        for key, tokens in preprocess.process_stream(misses(), config["PREPROCESS_WORKERS"]):
+            cache.put(key, tokens)
+            tokenized += 1
+    metrics.count("processor.documents_tokenized", tokenized)
+    metrics.count("processor.token_cache_hits", len(keys) - tokenized)
     
-    return regex
+    print(f"Tokenized {tokenized} documents, {len(keys) - tokenized} loaded from the token cache...")
+    return TokenCorpus(cache, keys)
+
+
+def train_epochs(model, processed_documents, epochs=None):
+    # Train one epoch at a time on one global learning rate schedule, so a wall-clock budget
+    # or a plateauing loss can stop training before the full epoch count
+    epochs = epochs or config["TRAIN_EPOCHS"]
+    track_loss = config["TRAIN_LOSS_TOLERANCE"] > 0
+    start = time.time()
+    words = 0
+    previous_loss = None
+    stalled = 0
+    
+    # train() overwrites alpha and min_alpha with each call's range, keep the originals for the schedule
+    alpha, min_alpha = model.alpha, model.min_alpha
+    for epoch in range(epochs):
+        start_alpha = alpha - (alpha - min_alpha) * epoch / epochs
+        end_alpha = alpha - (alpha - min_alpha) * (epoch + 1) / epochs
+        _, raw_words = model.train(processed_documents, total_examples=len(processed_documents), epochs=1,
+                                 start_alpha=start_alpha, end_alpha=end_alpha, compute_loss=track_loss)
+        words += raw_words
+        
+        if config["TRAIN_TIME_LIMIT"] and time.time() - start >= config["TRAIN_TIME_LIMIT"]:
+            print(f"Training time limit reached after {epoch + 1} epochs...")
+            break
+        
+        if track_loss:
+            loss = model.get_latest_training_loss()
+            if previous_loss and (previous_loss - loss) / previous_loss < config["TRAIN_LOSS_TOLERANCE"]:
+                stalled += 1
+                if stalled >= config["TRAIN_PATIENCE"]:
+                    print(f"Training loss plateaued at {loss:.0f} after {epoch + 1} epochs...")
+                    break
+            else:
+                stalled = 0
+            previous_loss = loss
+    
+    model.alpha, model.min_alpha = alpha, min_alpha
+    elapsed = time.time() - start
+    metrics.record("processor.train", elapsed)
+    metrics.count("processor.training_words", words)
+    print(f"Trained on {words} words in {elapsed:.1f}s ({words / elapsed if elapsed else 0:.0f} words/sec)...")
+    return model
 
 
 def model_setup(processed_documents):
-    model = Word2Vec(sentences=processed_documents, vector_size=500, window=6, min_count=0, workers=8)
-    model.train(processed_documents, total_examples=model.corpus_count, total_words=model.corpus_total_words, epochs=200)
+    model = Word2Vec(vector_size=config["VECTOR_SIZE"], window=6, min_count=0, workers=8)
+    model.build_vocab(processed_documents)
+    train_epochs(model, processed_documents)
     model.save(config["MODEL_PATH"])
     return model
 
 
-def vectorize_documents(processed_documents, model):
-    doc_vecs = []
+def model_update(processed_documents, model):
+    # Add new words to the existing vocabulary and train on the changed documents only
+    model.build_vocab(processed_documents, update=True)
+    train_epochs(model, processed_documents)
+    model.save(config["MODEL_PATH"])
+    return model
 
-    # For every document in the processed_documents list
+
+def vectorize_documents(processed_documents, model):
+    # For every document in the processed_documents corpus, yield its vector
     for document in processed_documents:
         word_vecs = []
     
@@ -84,15 +208,11 @@ def vectorize_documents(processed_documents, model):
         
         # If there are word vectors, average them to set as the document vector
         if word_vecs:
-            document_avg = np.mean(word_vecs, axis=0)
+            yield np.mean(word_vecs, axis=0)
         else:
-            document_avg = np.zeros(model.vector_size)
-        
-        # Append the document vector to the doc_vecs list    
-        doc_vecs.append(document_avg)
+            yield np.zeros(model.vector_size)
 
-    print("Document vectors generated...")        
-    return doc_vecs
+    print("Document vectors generated...")
 
 
 def normalize(vec):
@@ -100,14 +220,85 @@ def normalize(vec):
     return vec / norm if norm != 0 else vec
 
 
-def append_vec(csv_data, idx_txt, doc_vecs):
-    # Convert doc_vecs to large string and replace commas with semicolons for CSV
-    vec_strs = [json.dumps(vec.tolist()) for vec in doc_vecs]
-    vec_strs = [vec.replace(",", ";") for vec in vec_strs]
+def build_ann_index(doc_vecs):
+    ivf = build_ivf(doc_vecs, config["ANN_LISTS"] or None)
+    recall, exact_ms, ann_ms = recall_at_k(doc_vecs, lambda queries, k: search_ivf(ivf, doc_vecs, queries, k, config["ANN_NPROBE"]))
     
-    # Append the vector representations to the CSV data
-    for idx, vec_str in zip(idx_txt, vec_strs):
-        csv_data[idx].append(vec_str)
+    print(f"ANN index built with {len(ivf['ann_centroids'])} lists, nprobe={config['ANN_NPROBE']}: "
+          f"recall@5 {recall:.3f}, {ann_ms:.2f}ms/query vs {exact_ms:.2f}ms/query brute force...")
+    return ivf
+
+
+def build_compact_matrix(bundle, doc_vecs):
+    precision = config["VECTOR_PRECISION"]
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown VECTOR_PRECISION {precision!r}, expected one of {', '.join(PRECISIONS)}")
+    compact = build_compact(bundle, doc_vecs, precision)
+    recall, exact_ms, compact_ms = recall_at_k(doc_vecs, lambda queries, k: search_compact(compact, doc_vecs, queries, k, config["RERANK_DEPTH"]))
+
+    size = sum(array.nbytes for array in compact.values())
+    print(f"{precision} matrix built, {size / 2**20:.1f}MB vs {doc_vecs.nbytes / 2**20:.1f}MB float32, "
+          f"rerank depth {config['RERANK_DEPTH']}: recall@5 {recall:.3f}, "
+          f"{compact_ms:.2f}ms/query vs {exact_ms:.2f}ms/query float32...")
+
+
+def passage_ranges(csv_data):
+    # Byte ranges of every passage and the document each belongs to, small enough to keep in memory
+    docs = []
+    ranges = []
+    for idx, row in enumerate(csv_data):
+        with open(row[2], "rb") as f:
+            raw = f.read()
+        for passage_range in split_passages(raw, config["PASSAGE_SIZE"], config["PASSAGE_OVERLAP"]):
+            docs.append(idx)
+            ranges.append(passage_range)
+    return np.array(docs, dtype=np.int32), np.array(ranges, dtype=np.int64).reshape(-1, 2)
+
+
+def read_passages(csv_data, docs, ranges):
+    # Stream (index, text) pairs for every passage, reading each document once
+    passage_idx = 0
+    for doc_idx, group in groupby(docs):
+        with open(csv_data[doc_idx][2], "rb") as f:
+            raw = f.read()
+        for _ in group:
+            start, end = ranges[passage_idx]
+            yield (passage_idx, raw[start:end].decode("utf-8"))
+            passage_idx += 1
+
+
+def build_passage_index(bundle, csv_data, model):
+    # Passages go through the same token cache, so unchanged passages are never re-tokenized
+    docs, ranges = passage_ranges(csv_data)
+    corpus = process_documents(read_passages(csv_data, docs, ranges))
+    matrix = bundle.open_array(PASSAGES, (len(docs), model.vector_size))
+    for idx, vec in enumerate(vectorize_documents(corpus, model)):
+        matrix[idx] = normalize(vec)
+    bundle.add_array(PASSAGE_DOCS, docs)
+    bundle.add_array(PASSAGE_RANGES, ranges)
+    if config["BM25_INDEX"]:
+        add_bm25_index(bundle, corpus, "passage_")
+    print(f"Passage index built with {len(docs)} passages from {len(csv_data)} documents...")
+
+
+def add_bm25_index(bundle, corpus, prefix=""):
+    arrays = build_bm25(corpus)
+    for name, array in arrays.items():
+        bundle.add_array(prefix + name, array)
+    print(f"BM25 index built with {len(arrays['bm25_idf'])} terms and {len(arrays['bm25_docs'])} postings...")
+
+
+def build_query_model(bundle, csv_data, model):
+    # Word vectors plus a stem map of every word in the corpus, so queries skip gensim and NLTK
+    stems = preprocess.build_stem_map(text for _, text in read_docs(csv_data))
+    export_query_model(bundle, model, stems, preprocess.get_preprocessor().stop_words)
+    print(f"Query model exported with {len(model.wv.index_to_key)} words and {len(stems)} stems...")
+
+
+def append_vec(csv_data, doc_vecs):
+    # Pack each vector as a float32 blob, base64 encoded so it fits in a CSV column
+    for row, vec in zip(csv_data, doc_vecs):
+        yield row + [to_text(encode_vector(vec))]
 
         
 def save_csv(data):
@@ -118,21 +309,111 @@ def save_csv(data):
     print("CSV file saved with document vectorizations...")
     
     
+def fill_matrix(matrix, corpus, model):
+    with metrics.timer("processor.vectorize"):
+        for idx, vec in enumerate(vectorize_documents(corpus, model)):
+            matrix[idx] = normalize(vec)
+
+
+def write_vectors(csv_data, matrix):
+    # Full run, every document is tokenized (or loaded from the token cache) and the model is retrained
+    corpus = process_documents(read_docs(csv_data))
+    model = model_setup(corpus)
+    fill_matrix(matrix, corpus, model)
+    return model
+
+
+def update_vectors(csv_data, changes, model, matrix):
+    # Copy last run's vectors and only re-tokenize and re-vectorize added or changed documents
+    manifest, previous = load_bundle(config["INDEX_PATH"])
+    previous_rows = {document["file_name"]: idx for idx, document in enumerate(manifest["documents"])}
+    affected = set(changes["added"]) | set(changes["changed"])
+    stale = [idx for idx, row in enumerate(csv_data) if row[0] in affected or row[0] not in previous_rows]
+    
+    corpus = process_documents(read_docs([csv_data[idx] for idx in stale]))
+    if config["INCREMENTAL_TRAIN"] and len(corpus):
+        model_update(corpus, model)
+        # Training moved the shared word vectors, so every stored document vector is stale as well.
+        # All tokens come from the token cache, this is a vectorize pass, not a re-tokenize.
+        fill_matrix(matrix, process_documents(read_docs(csv_data)), model)
+        print(f"Model updated on {len(stale)} documents, re-vectorized all {len(csv_data)}...")
+        return
+    stale_vecs = zip(stale, vectorize_documents(corpus, model))
+    next_stale = next(stale_vecs, None)
+    with metrics.timer("processor.vectorize"):
+        for idx, row in enumerate(csv_data):
+            if next_stale is not None and next_stale[0] == idx:
+                matrix[idx] = normalize(next_stale[1])
+                next_stale = next(stale_vecs, None)
+            else:
+                matrix[idx] = previous[previous_rows[row[0]]]
+    
+    print(f"Re-vectorized {len(stale)} of {len(csv_data)} documents...")
+
+
+def can_update(changes):
+    return changes is not None and bundle_exists(config["INDEX_PATH"]) and os.path.exists(config["MODEL_PATH"])
+
+
 def main():    
+    with metrics.timer("processor.total"):
+        process()
+
+
+def process():
     print("Processing documents...")
 
     csv_path                = config["DOWNLOADS_PATH"] + "/data.csv"
     csv_data                = read_csv(csv_path)
-    document_list           = read_docs(csv_data)
-    processed_documents     = [process_text(document) for document in document_list]
-    model                   = model_setup(processed_documents)
-    doc_vecs                = vectorize_documents(processed_documents, model)
-    doc_vecs                = np.array([normalize(vec) for vec in doc_vecs])
-    index                   = MatrixSimilarity(doc_vecs, num_features=model.vector_size)
+    changes                 = load_changes(config["DOWNLOADS_PATH"]) if config["INCREMENTAL"] else None
+    incremental             = can_update(changes)
+    
+    # Incremental run, update the existing model and only touch the documents the crawler saw change
+    if incremental and not has_changes(changes):
+        print("No document changes, keeping the existing model and index...")
+        return
+    if config["DEDUP"]:
+        with metrics.timer("processor.dedup"):
+            csv_data        = drop_duplicates(csv_data)
+        if incremental:
+            reconcile_changes(changes, csv_data)
+    metrics.count("processor.documents", len(csv_data))
+    with metrics.timer("processor.load_model"):
+        model               = Word2Vec.load(config["MODEL_PATH"]) if incremental else None
+    
+    # Vectors stream straight into the bundle's memory-mapped matrix
+    bundle                  = BundleWriter(config["INDEX_PATH"])
+    matrix                  = bundle.open_vectors(len(csv_data), model.vector_size if model else config["VECTOR_SIZE"])
+    
+    if incremental:
+        update_vectors(csv_data, changes, model, matrix)
+    else:
+        model               = write_vectors(csv_data, matrix)
+    
+    if config["ANN_INDEX"]:
+        with metrics.timer("processor.ann"):
+            for name, array in build_ann_index(matrix).items():
+                bundle.add_array(name, array)
+    if config["VECTOR_PRECISION"] != "float32":
+        with metrics.timer("processor.quantize"):
+            build_compact_matrix(bundle, matrix)
+    if config["BM25_INDEX"]:
+        # Every document's tokens, unchanged ones come straight from the token cache
+        with metrics.timer("processor.bm25"):
+            add_bm25_index(bundle, process_documents(read_docs(csv_data)))
+    if config["PASSAGE_INDEX"]:
+        with metrics.timer("processor.passages"):
+            build_passage_index(bundle, csv_data, model)
+    with metrics.timer("processor.query_model"):
+        build_query_model(bundle, csv_data, model)
+    with metrics.timer("processor.filters"):
+        build_filters(bundle, [document_record(row) for row in csv_data])
 
-    append_vec(csv_data, [idx for idx, _ in document_list], doc_vecs)
-    save_csv(csv_data)
+    with metrics.timer("processor.commit"):
+        bundle.commit(csv_data, model)
+    with metrics.timer("processor.save_csv"):
+        save_csv(append_vec(csv_data, matrix))
     
     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
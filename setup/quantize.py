@@ -0,0 +1,69 @@
+import numpy as np
+
+# Reduced-precision copies of the normalized document matrix, scored first so only a handful of
+# full-precision rows are read per query:
+#   vectors_f16     float16 matrix, half the size of the float32 one
+#   vectors_i8      int8 codes, a quarter of the size, row i is approximately codes[i] * scale
+#   vectors_scale   float32 per-dimension scale of the int8 codes
+# The top `depth` candidates of the compact scores are re-ranked with their float32 vectors, the
+# float32 matrix stays memory-mapped and only those rows get paged in.
+PRECISIONS = ("float32", "float16", "int8")
+F16 = "vectors_f16"
+I8 = "vectors_i8"
+SCALE = "vectors_scale"
+CHUNK_SIZE = 16384
+
+
+def build_compact(bundle, matrix, precision):
+    # Streams the compact matrix into the bundle chunk by chunk, like the float32 one
+    if precision == "float16":
+        compact = bundle.open_array(F16, matrix.shape, np.float16)
+        for start in range(0, matrix.shape[0], CHUNK_SIZE):
+            compact[start:start + CHUNK_SIZE] = matrix[start:start + CHUNK_SIZE]
+        return {F16: compact}
+
+    # Symmetric scalar quantization, every dimension gets the scale that maps its largest magnitude to 127
+    peak = np.zeros(matrix.shape[1], dtype=np.float32)
+    for start in range(0, matrix.shape[0], CHUNK_SIZE):
+        peak = np.maximum(peak, np.abs(matrix[start:start + CHUNK_SIZE]).max(axis=0, initial=0))
+    scale = np.where(peak > 0, peak / 127, 1).astype(np.float32)
+    codes = bundle.open_array(I8, matrix.shape, np.int8)
+    for start in range(0, matrix.shape[0], CHUNK_SIZE):
+        codes[start:start + CHUNK_SIZE] = np.clip(np.rint(matrix[start:start + CHUNK_SIZE] / scale), -127, 127)
+    bundle.add_array(SCALE, scale)
+    return {I8: codes, SCALE: scale}
+
+
+def compact_scores(compact, queries, rows=None):
+    # Scores against the compact matrix, upcast a chunk at a time so no float32 copy of it is ever held.
+    # rows (ascending ids) limits scoring to those rows, the scores are then in rows order.
+    if F16 in compact:
+        codes = compact[F16]
+    else:
+        # Folding the scale into the queries leaves a plain product with the codes
+        codes = compact[I8]
+        queries = queries * compact[SCALE]
+    count = codes.shape[0] if rows is None else len(rows)
+    scores = np.empty((queries.shape[0], count), dtype=np.float32)
+    for start in range(0, count, CHUNK_SIZE):
+        chunk = codes[start:start + CHUNK_SIZE] if rows is None else codes[rows[start:start + CHUNK_SIZE]]
+        scores[:, start:start + CHUNK_SIZE] = queries @ chunk.astype(np.float32).T
+    return scores
+
+
+def search_compact(compact, matrix, queries, k, depth, rows=None):
+    scores = compact_scores(compact, queries, rows)
+    depth = min(max(k, depth), scores.shape[1])
+    candidates = np.argpartition(-scores, depth - 1, axis=1)[:, :depth]
+    if rows is not None:
+        candidates = rows[candidates]
+
+    results = []
+    for query, query_candidates in zip(queries, candidates):
+        # Exact re-rank of the candidates with the full vectors, read in row order
+        query_candidates = np.sort(query_candidates)
+        exact = matrix[query_candidates] @ query
+        top = np.argsort(-exact, kind="stable")[:k]
+        results.append((query_candidates[top], exact[top]))
+    return results
+
@@ -0,0 +1,64 @@
+import numpy as np
+from bundle import load_array
+from preprocess import PREPROCESS_VERSION, FastPreprocessor
+
+# Query-only export of the word2vec model, written into the bundle by the processor so the query
+# path neither imports gensim nor unpickles the training model:
+#   query_vectors    float32 word vectors, one row per vocabulary entry
+#   query_vocab      vocabulary in row order, newline separated UTF-8
+#   query_stems      "word<TAB>token" lines, the stem map for FastPreprocessor
+#   query_stopwords  newline separated stopwords
+VECTORS = "query_vectors"
+VOCAB = "query_vocab"
+STEMS = "query_stems"
+STOPWORDS = "query_stopwords"
+NAMES = (VECTORS, VOCAB, STEMS, STOPWORDS)
+
+
+def encode_strings(strings):
+    return np.frombuffer("\n".join(strings).encode("utf-8"), dtype=np.uint8)
+
+
+def decode_strings(array):
+    text = np.asarray(array).tobytes().decode("utf-8")
+    return text.split("\n") if text else []
+
+
+def export_query_model(bundle, model, stems, stop_words):
+    bundle.add_array(VECTORS, np.asarray(model.wv.vectors, dtype=np.float32))
+    bundle.add_array(VOCAB, encode_strings(model.wv.index_to_key))
+    bundle.add_array(STEMS, encode_strings(f"{word}\t{token or ''}" for word, token in sorted(stems.items())))
+    bundle.add_array(STOPWORDS, encode_strings(sorted(stop_words)))
+    bundle.meta["preprocess_version"] = PREPROCESS_VERSION
+
+
+class QueryModel:
+    # Stands in for the gensim model on the query path, supports model.wv[word], word in model.wv
+    # and model.vector_size over the memory-mapped vectors
+    def __init__(self, vocab, vectors):
+        self.key_to_index = {word: idx for idx, word in enumerate(vocab)}
+        self.vectors = vectors
+        self.vector_size = vectors.shape[1]
+        self.wv = self
+
+    def __contains__(self, word):
+        return word in self.key_to_index
+
+    def __getitem__(self, word):
+        return self.vectors[self.key_to_index[word]]
+
+
+def load_query_model(index_path, manifest):
+    # (QueryModel, FastPreprocessor), or None for bundles without the export or from another preprocessing version
+    if manifest.get("preprocess_version") != PREPROCESS_VERSION:
+        return None
+    arrays = {name: load_array(index_path, manifest, name) for name in NAMES}
+    if any(array is None for array in arrays.values()):
+        return None
+
+    stems = {}
+    for line in decode_strings(arrays[STEMS]):
+        word, _, token = line.partition("\t")
+        stems[word] = token or None
+    model = QueryModel(decode_strings(arrays[VOCAB]), arrays[VECTORS])
+    return model, FastPreprocessor(stems, set(decode_strings(arrays[STOPWORDS])))
@@ -1,4 +1,6 @@
+import argparse
 import os
+import subprocess
 import sys
 from dotenv import load_dotenv
 
@@ -11,19 +13,56 @@ setup_dir = os.path.join(config['WORKING_DIR'], 'setup')
 if setup_dir not in sys.path:
     sys.path.insert(0, setup_dir)
 
-import crawler
-import processor
-import upload
+import metrics
+from shards import load_shards, select_shards, shard_env
 
 def run_module(module, name):
     if hasattr(module, 'main'):
-        module.main() 
+        with metrics.timer(f"setup.{name}"):
+            module.main() 
     else:
         print(f"No main() function found in the {name} module.")
 
-if __name__ == "__main__":
+def run_pipeline():
+    # Imported here, the modules read their config when imported and shard builds run in child processes
+    import crawler
+    import processor
+    import upload
+
     run_module(crawler, 'crawler')
     run_module(processor, 'processor')
     run_module(upload, 'upload')
+
+def build_shards(names, args):
+    # Every shard runs the whole pipeline in its own process with its own paths and crawl settings
+    shards = load_shards()
+    if not shards:
+        print("No shards configured, create shards.json in WORKING_DIR or set SHARDS_PATH")
+        sys.exit(1)
+    for name in select_shards(shards, [] if "all" in names else names):
+        print(f"Building shard {name}...", flush=True)
+        command = [sys.executable, os.path.abspath(__file__)]
+        if args.metrics:
+            command += ["--metrics", args.metrics]
+        if args.profile:
+            command += ["--profile", f"{args.profile}.{name}"]
+        subprocess.run(command, env={**os.environ, **shard_env(name, shards[name])}, check=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--metrics", choices=metrics.FORMATS, help="record stage timings, overrides METRICS")
+    parser.add_argument("--profile", metavar="FILE", help="dump a cProfile of the whole pipeline to FILE")
+    parser.add_argument("--shard", action="append", metavar="NAME",
+                        help="build this shard from shards.json instead, repeatable, 'all' builds every shard")
+    args = parser.parse_args()
+
+    if args.shard:
+        build_shards(args.shard, args)
+        print("All shards built successfully.")
+        sys.exit(0)
+
+    metrics.configure(args.metrics)
+    with metrics.profile(args.profile):
+        run_pipeline()
     
     print("All modules executed successfully.")
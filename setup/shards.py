@@ -0,0 +1,73 @@
+import json
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Named shards, one per documentation site, listed in shards.json as environment overrides:
+#
+#   {
+#       "opendental": {"CRAWL_START_URL": "https://www.opendental.com/site/apispecification.html",
+#                      "CRAWL_WHITELIST": "https://www.opendental.com/site/api"},
+#       "manual":     {"CRAWL_START_URL": "https://www.opendental.com/manual/manual.html",
+#                      "CRAWL_WHITELIST": "https://www.opendental.com/manual/", "TRAIN_EPOCHS": "100"}
+#   }
+#
+# Each shard is crawled into DOWNLOADS_PATH/shards/<name>, trains its own model there unless it sets
+# MODEL_PATH, uploads to its own SQLite database unless it sets its storage, and writes its bundle
+# to INDEX_PATH/<name>. Shards are built one at a time, so a new site never rebuilds the others.
+config = {
+    "SHARDS_PATH":    os.getenv("SHARDS_PATH") or os.path.join(os.getenv("WORKING_DIR", ""), "shards.json"),
+    "DOWNLOADS_PATH": os.getenv("DOWNLOADS_PATH"),
+    "INDEX_PATH":     os.getenv("INDEX_PATH") or os.path.join(os.getenv("DOWNLOADS_PATH", ""), "index"),
+}
+
+SHARD_NAME = re.compile(r"[A-Za-z0-9_-]+$")
+
+
+def load_shards(path=None):
+    # Shard name -> environment overrides, empty without a shards file
+    path = path or config["SHARDS_PATH"]
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        shards = json.load(f)
+
+    for name, settings in shards.items():
+        if not SHARD_NAME.match(name):
+            raise ValueError(f"Invalid shard name {name!r} in {path}, use letters, digits, - and _")
+        if not isinstance(settings, dict):
+            raise ValueError(f"Shard {name!r} in {path} must map to an object of settings")
+        # Lists (whitelists and the like) are passed on comma separated
+        shards[name] = {key: ",".join(value) if isinstance(value, list) else str(value) for key, value in settings.items()}
+    return shards
+
+
+def select_shards(shards, names):
+    # Every shard when names is empty, otherwise the named ones in the given order
+    if not names:
+        return list(shards)
+    unknown = [name for name in names if name not in shards]
+    if unknown:
+        raise ValueError(f"Unknown shards {', '.join(unknown)}, expected some of {', '.join(shards)}")
+    return list(dict.fromkeys(names))
+
+
+def shard_index_path(name):
+    return os.path.join(config["INDEX_PATH"], name)
+
+
+def shard_env(name, settings):
+    downloads = os.path.join(config["DOWNLOADS_PATH"], "shards", name)
+    env = {
+        "SHARD":            name,
+        "DOWNLOADS_PATH":   downloads,
+        "INDEX_PATH":       shard_index_path(name),
+        "MODEL_PATH":       os.path.join(downloads, "word2vec.model"),
+        "TOKEN_CACHE_PATH": os.path.join(downloads, "token_cache"),
+        "STORAGE_BACKEND":  "sqlite",
+        "SQLITE_PATH":      os.path.join(downloads, "documents.db"),
+    }
+    env.update(settings)
+    return env
@@ -0,0 +1,161 @@
+# Port of NLTK's PorterStemmer in its default NLTK_EXTENSIONS mode, so the query path can stem words
+# the exported stem map doesn't know without importing NLTK. preprocess_test.py checks it against NLTK.
+VOWELS = frozenset("aeiou")
+IRREGULAR_FORMS = {
+    "sky": "sky", "skies": "sky", "dying": "die", "lying": "lie", "tying": "tie", "news": "news",
+    "innings": "inning", "inning": "inning", "outings": "outing", "outing": "outing",
+    "cannings": "canning", "canning": "canning", "howe": "howe", "proceed": "proceed",
+    "exceed": "exceed", "succeed": "succeed",
+}
+
+
+def is_consonant(word, i):
+    if word[i] in VOWELS:
+        return False
+    if word[i] == "y":
+        negate = False
+        while i > 0 and word[i] == "y":
+            negate = not negate
+            i -= 1
+        return (word[i] not in VOWELS) != negate
+    return True
+
+
+def consonant_flags(word):
+    flags = []
+    for i, ch in enumerate(word):
+        if ch in VOWELS:
+            flags.append(False)
+        elif ch == "y":
+            flags.append(True if i == 0 else not flags[i - 1])
+        else:
+            flags.append(True)
+    return flags
+
+
+def measure(stem):
+    return "".join("c" if flag else "v" for flag in consonant_flags(stem)).count("vc")
+
+
+def positive_measure(stem):
+    return measure(stem) > 0
+
+
+def measure_gt_1(stem):
+    return measure(stem) > 1
+
+
+def contains_vowel(stem):
+    return not all(consonant_flags(stem))
+
+
+def ends_double_consonant(word):
+    return len(word) >= 2 and word[-1] == word[-2] and is_consonant(word, len(word) - 1)
+
+
+def ends_cvc(word):
+    return (len(word) >= 3 and is_consonant(word, len(word) - 3) and not is_consonant(word, len(word) - 2)
+            and is_consonant(word, len(word) - 1) and word[-1] not in ("w", "x", "y")) or (
+        len(word) == 2 and not is_consonant(word, 0) and is_consonant(word, 1))
+
+
+def apply_rules(word, rules):
+    # The first rule whose suffix matches decides, even when its condition fails
+    for suffix, replacement, condition in rules:
+        if suffix == "*d" and ends_double_consonant(word):
+            stem = word[:-2]
+            return stem + replacement if condition is None or condition(stem) else word
+        if word.endswith(suffix):
+            stem = word[:len(word) - len(suffix)]
+            return stem + replacement if condition is None or condition(stem) else word
+    return word
+
+
+def step1a(word):
+    if word.endswith("ies") and len(word) == 4:
+        return word[:-3] + "ie"
+    return apply_rules(word, [("sses", "ss", None), ("ies", "i", None), ("ss", "ss", None), ("s", "", None)])
+
+
+def step1b(word):
+    if word.endswith("ied"):
+        return word[:-3] + ("ie" if len(word) == 4 else "i")
+    if word.endswith("eed"):
+        stem = word[:-3]
+        return stem + "ee" if measure(stem) > 0 else word
+
+    for suffix in ("ed", "ing"):
+        if word.endswith(suffix) and contains_vowel(word[:-len(suffix)]):
+            stem = word[:-len(suffix)]
+            break
+    else:
+        return word
+    return apply_rules(stem, [
+        ("at", "ate", None),
+        ("bl", "ble", None),
+        ("iz", "ize", None),
+        ("*d", stem[-1], lambda _: stem[-1] not in ("l", "s", "z")),
+        ("", "e", lambda rest: measure(rest) == 1 and ends_cvc(rest)),
+    ])
+
+
+def step1c(word):
+    return apply_rules(word, [("y", "i", lambda stem: len(stem) > 1 and is_consonant(stem, len(stem) - 1))])
+
+
+STEP2_RULES = [
+    ("ational", "ate"), ("tional", "tion"), ("enci", "ence"), ("anci", "ance"), ("izer", "ize"),
+    ("bli", "ble"), ("alli", "al"), ("entli", "ent"), ("eli", "e"), ("ousli", "ous"), ("ization", "ize"),
+    ("ation", "ate"), ("ator", "ate"), ("alism", "al"), ("iveness", "ive"), ("fulness", "ful"),
+    ("ousness", "ous"), ("aliti", "al"), ("iviti", "ive"), ("biliti", "ble"), ("fulli", "ful"),
+]
+
+
+def step2(word):
+    if word.endswith("alli") and positive_measure(word[:-4]):
+        return step2(word[:-4] + "al")
+    rules = [(suffix, replacement, positive_measure) for suffix, replacement in STEP2_RULES]
+    rules.append(("logi", "log", lambda _: positive_measure(word[:-3])))
+    return apply_rules(word, rules)
+
+
+def step3(word):
+    return apply_rules(word, [
+        ("icate", "ic", positive_measure), ("ative", "", positive_measure), ("alize", "al", positive_measure),
+        ("iciti", "ic", positive_measure), ("ical", "ic", positive_measure), ("ful", "", positive_measure),
+        ("ness", "", positive_measure),
+    ])
+
+
+STEP4_SUFFIXES = ["al", "ance", "ence", "er", "ic", "able", "ible", "ant", "ement", "ment", "ent", "ion",
+                  "ou", "ism", "ate", "iti", "ous", "ive", "ize"]
+
+
+def step4(word):
+    return apply_rules(word, [
+        (suffix, "", (lambda stem: measure(stem) > 1 and stem[-1] in ("s", "t")) if suffix == "ion" else measure_gt_1)
+        for suffix in STEP4_SUFFIXES
+    ])
+
+
+def step5a(word):
+    if word.endswith("e"):
+        stem = word[:-1]
+        if measure(stem) > 1 or (measure(stem) == 1 and not ends_cvc(stem)):
+            return stem
+    return word
+
+
+def step5b(word):
+    return apply_rules(word, [("ll", "l", lambda _: measure(word[:-1]) > 1)])
+
+
+def stem(word):
+    word = word.lower()
+    if word in IRREGULAR_FORMS:
+        return IRREGULAR_FORMS[word]
+    if len(word) <= 2:
+        return word
+    for step in (step1a, step1b, step1c, step2, step3, step4, step5a, step5b):
+        word = step(word)
+    return word
@@ -0,0 +1,250 @@
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from vectors import encode_vector, parse_legacy_vector
+
+# Document table storage shared by upload.py and the query engine. STORAGE_BACKEND picks MySQL
+# (the Docker container from the README) or an embedded SQLite file at SQLITE_PATH, both store
+# vectors as the same float32 BLOBs. Each backend only supplies its SQL dialect.
+TABLE = "webpages"
+STAGING_TABLE = "webpages_staging"
+OLD_TABLE = "webpages_old"
+BACKENDS = ("mysql", "sqlite")
+
+
+class Storage(ABC):
+    placeholder = "%s"
+
+    @abstractmethod
+    def connect(self):
+        ...
+
+    def placeholders(self, count):
+        return ", ".join([self.placeholder] * count)
+
+    @abstractmethod
+    def create_table(self, cursor, table=TABLE):
+        ...
+
+    @abstractmethod
+    def create_meta_table(self, cursor):
+        ...
+
+    @abstractmethod
+    def bump_generation(self, cursor):
+        ...
+
+    @abstractmethod
+    def table_exists(self, cursor, table):
+        ...
+
+    def migrate_table(self, cursor):
+        # Only MySQL tables predate binary vectors
+        return False
+
+    def insert_rows(self, cursor, rows, table=TABLE, batch_size=1000):
+        # executemany sends each batch in one go instead of one statement per row
+        insert_query = f"""
+        INSERT INTO {table} (file_name, page_name, file_path, url, vector_representation)
+        VALUES ({self.placeholders(5)})
+        """
+        inserted = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                cursor.executemany(insert_query, batch)
+                inserted += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(insert_query, batch)
+            inserted += len(batch)
+        return inserted
+
+    def delete_rows(self, cursor, file_names, chunk_size=500):
+        for start in range(0, len(file_names), chunk_size):
+            names = file_names[start:start + chunk_size]
+            cursor.execute(f"DELETE FROM {TABLE} WHERE file_name IN ({self.placeholders(len(names))})", names)
+
+    @abstractmethod
+    def swap_tables(self, connection, cursor):
+        ...
+
+    def fetch_rows(self):
+        # (file_path, vector blob) for every document, the query path's only read
+        connection = self.connect()
+        cursor = connection.cursor()
+        cursor.execute(f"SELECT file_path, vector_representation FROM {TABLE}")
+        rows = cursor.fetchall()
+        cursor.close()
+        connection.close()
+        return rows
+
+    def fetch_generation(self):
+        # Bumped by upload.py on every publish, 0 for tables uploaded before generations existed
+        connection = self.connect()
+        cursor = connection.cursor()
+        row = None
+        if self.table_exists(cursor, "index_meta"):
+            cursor.execute("SELECT generation FROM index_meta WHERE id = 1")
+            row = cursor.fetchone()
+        cursor.close()
+        connection.close()
+        return row[0] if row else 0
+
+
+class MySQLStorage(Storage):
+    def __init__(self, host, port, user, password, database):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.database = database
+
+    def connect(self):
+        # Imported here so the embedded backend runs without the MySQL connector installed
+        import mysql.connector
+        return mysql.connector.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+        )
+
+    def create_table(self, cursor, table=TABLE):
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            file_name VARCHAR(255),
+            page_name VARCHAR(255),
+            file_path VARCHAR(255),
+            url VARCHAR(255),
+            vector_representation BLOB
+        )
+        """)
+
+    def create_meta_table(self, cursor):
+        # Single row holding the generation of the published table
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS index_meta (
+            id TINYINT PRIMARY KEY,
+            generation BIGINT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+        """)
+
+    def bump_generation(self, cursor):
+        cursor.execute("""
+        INSERT INTO index_meta (id, generation) VALUES (1, 1)
+        ON DUPLICATE KEY UPDATE generation = generation + 1
+        """)
+        cursor.execute("SELECT generation FROM index_meta WHERE id = 1")
+        return cursor.fetchone()[0]
+
+    def table_exists(self, cursor, table):
+        cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """, (table,))
+        return cursor.fetchone()[0] > 0
+
+    def migrate_table(self, cursor):
+        # Convert tables created before binary vectors from semicolon-joined TEXT to float32 BLOBs
+        cursor.execute("""
+        SELECT DATA_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'webpages' AND COLUMN_NAME = 'vector_representation'
+        """)
+        column = cursor.fetchone()
+        if not column or column[0].lower() not in ("text", "mediumtext", "longtext"):
+            return False
+
+        print("Migrating webpages.vector_representation from TEXT to BLOB...")
+        cursor.execute("ALTER TABLE webpages ADD COLUMN vector_blob BLOB")
+        cursor.execute("SELECT id, vector_representation FROM webpages")
+        rows = cursor.fetchall()
+        for row_id, vector_str in rows:
+            blob = encode_vector(parse_legacy_vector(vector_str)) if vector_str else None
+            cursor.execute("UPDATE webpages SET vector_blob = %s WHERE id = %s", (blob, row_id))
+        cursor.execute("ALTER TABLE webpages DROP COLUMN vector_representation")
+        cursor.execute("ALTER TABLE webpages CHANGE vector_blob vector_representation BLOB")
+        print(f"Migrated {len(rows)} rows...")
+        return True
+
+    def swap_tables(self, connection, cursor):
+        # RENAME TABLE swaps both names in one atomic step
+        cursor.execute(f"DROP TABLE IF EXISTS {OLD_TABLE}")
+        if self.table_exists(cursor, TABLE):
+            cursor.execute(f"RENAME TABLE {TABLE} TO {OLD_TABLE}, {STAGING_TABLE} TO {TABLE}")
+            cursor.execute(f"DROP TABLE {OLD_TABLE}")
+        else:
+            cursor.execute(f"RENAME TABLE {STAGING_TABLE} TO {TABLE}")
+
+
+class SQLiteStorage(Storage):
+    placeholder = "?"
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        # WAL lets queries keep reading the last committed table while an upload writes
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def create_table(self, cursor, table=TABLE):
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_name TEXT,
+            page_name TEXT,
+            file_path TEXT,
+            url TEXT,
+            vector_representation BLOB
+        )
+        """)
+
+    def create_meta_table(self, cursor):
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS index_meta (
+            id INTEGER PRIMARY KEY,
+            generation INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+    def bump_generation(self, cursor):
+        cursor.execute("""
+        INSERT INTO index_meta (id, generation) VALUES (1, 1)
+        ON CONFLICT(id) DO UPDATE SET generation = generation + 1, updated_at = CURRENT_TIMESTAMP
+        """)
+        cursor.execute("SELECT generation FROM index_meta WHERE id = 1")
+        return cursor.fetchone()[0]
+
+    def table_exists(self, cursor, table):
+        cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        return cursor.fetchone()[0] > 0
+
+    def swap_tables(self, connection, cursor):
+        # SQLite DDL is transactional, both renames commit together
+        connection.commit()
+        cursor.execute("BEGIN")
+        cursor.execute(f"DROP TABLE IF EXISTS {OLD_TABLE}")
+        if self.table_exists(cursor, TABLE):
+            cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}")
+            cursor.execute(f"ALTER TABLE {STAGING_TABLE} RENAME TO {TABLE}")
+            cursor.execute(f"DROP TABLE {OLD_TABLE}")
+        else:
+            cursor.execute(f"ALTER TABLE {STAGING_TABLE} RENAME TO {TABLE}")
+        connection.commit()
+
+
+def open_storage(config):
+    backend = (config["STORAGE_BACKEND"] or "mysql").lower()
+    if backend == "mysql":
+        return MySQLStorage(config["HOST"], config["PORT"], config["USER"], config["PASSWORD"], config["DATABASE"])
+    if backend == "sqlite":
+        return SQLiteStorage(config["SQLITE_PATH"])
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}")
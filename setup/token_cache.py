@@ -0,0 +1,79 @@
+import hashlib
+import os
+import numpy as np
+
+# Persistent cache of tokenized documents, keyed by a hash of the cleaned text and the preprocessing
+# version. Tokens are stored as uint32 ids into an append-only vocab.txt, one small array file per
+# document under a two character shard directory.
+VOCAB_FILE = "vocab.txt"
+ID_DTYPE = np.dtype("<u4")
+
+
+class TokenCache:
+    def __init__(self, cache_path, version):
+        self.cache_path = cache_path
+        self.version = version
+        os.makedirs(cache_path, exist_ok=True)
+
+        self.vocab = []
+        vocab_path = os.path.join(cache_path, VOCAB_FILE)
+        if os.path.exists(vocab_path):
+            with open(vocab_path, "r", encoding="utf-8") as f:
+                self.vocab = f.read().split("\n")[:-1]
+        self.ids = {token: idx for idx, token in enumerate(self.vocab)}
+        self.saved_vocab = len(self.vocab)
+
+    def key(self, text):
+        digest = hashlib.sha256(f"{self.version}\0".encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_path, key[:2], key + ".bin")
+
+    def load(self, key):
+        # Token ids of an entry, None when it is missing or can't be decoded with the saved vocabulary
+        path = self.entry_path(key)
+        if not os.path.exists(path) or os.path.getsize(path) % ID_DTYPE.itemsize:
+            return None
+        ids = np.fromfile(path, dtype=ID_DTYPE)
+        # Ids past the saved vocabulary mean the vocab write never finished or vocab.txt was cut short
+        if len(ids) and ids.max() >= len(self.vocab):
+            return None
+        return ids
+
+    def has(self, key):
+        # Agrees with get(), entries that fail to decode are re-tokenized and overwritten
+        return self.load(key) is not None
+
+    def get(self, key):
+        ids = self.load(key)
+        if ids is None:
+            return None
+        return [self.vocab[idx] for idx in ids]
+
+    def token_ids(self, tokens):
+        ids = np.empty(len(tokens), dtype=ID_DTYPE)
+        for i, token in enumerate(tokens):
+            idx = self.ids.get(token)
+            if idx is None:
+                idx = self.ids[token] = len(self.vocab)
+                self.vocab.append(token)
+            ids[i] = idx
+        return ids
+
+    def put(self, key, tokens):
+        ids = self.token_ids(tokens)
+
+        # New vocabulary goes to disk before the entry that references it
+        self.save_vocab()
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ids.tofile(path)
+
+    def save_vocab(self):
+        if self.saved_vocab == len(self.vocab):
+            return
+        with open(os.path.join(self.cache_path, VOCAB_FILE), "a", encoding="utf-8") as f:
+            f.write("".join(token + "\n" for token in self.vocab[self.saved_vocab:]))
+        self.saved_vocab = len(self.vocab)
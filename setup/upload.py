@@ -1,61 +1,44 @@
 import csv
-import mysql.connector
 import os
+import sys
 from dotenv import load_dotenv
+from vectors import from_text
+from changes import clear_changes, has_changes, load_changes
+from storage import STAGING_TABLE, open_storage
+import metrics
 
 load_dotenv()
 
 config = {
-    "DOWNLOADS_PATH": os.getenv("DOWNLOADS_PATH"),
-    "MODEL_PATH":     os.getenv("MODEL_PATH"),
-    "WORKING_DIR":    os.getenv("WORKING_DIR"),
-    
-    "HOST":           os.getenv("MYSQL_HOST"),
-    "PORT":           os.getenv("MYSQL_PORT"),
-    "USER":           os.getenv("MYSQL_USER"),
-    "PASSWORD":       os.getenv("MYSQL_PASSWORD"),
-    "DATABASE":       os.getenv("MYSQL_DATABASE"),
+    "DOWNLOADS_PATH":  os.getenv("DOWNLOADS_PATH"),
+    "MODEL_PATH":      os.getenv("MODEL_PATH"),
+    "WORKING_DIR":     os.getenv("WORKING_DIR"),
+
+    "STORAGE_BACKEND": os.getenv("STORAGE_BACKEND", "mysql"),
+    "SQLITE_PATH":     os.getenv("SQLITE_PATH") or os.path.join(os.getenv("DOWNLOADS_PATH", ""), "documents.db"),
+    "HOST":            os.getenv("MYSQL_HOST"),
+    "PORT":            os.getenv("MYSQL_PORT"),
+    "USER":            os.getenv("MYSQL_USER"),
+    "PASSWORD":        os.getenv("MYSQL_PASSWORD"),
+    "DATABASE":        os.getenv("MYSQL_DATABASE"),
+
+    "INCREMENTAL":     os.getenv("INCREMENTAL", "false").lower() in ("1", "true", "yes"),
+    "UPLOAD_BATCH":    int(os.getenv("UPLOAD_BATCH") or 1000),
 }
 
-def create_table(cursor):
-    create_table_query = """
-    CREATE TABLE IF NOT EXISTS webpages (
-        id INT AUTO_INCREMENT PRIMARY KEY,
-        file_name VARCHAR(255),
-        page_name VARCHAR(255),
-        file_path VARCHAR(255),
-        url VARCHAR(255),
-        vector_representation TEXT
-    )
-    """
-    cursor.execute(create_table_query)
-    
-def reset_table(cursor):
-    truncate_table_query = """
-    TRUNCATE TABLE webpages
-    """
-    cursor.execute(truncate_table_query)
-    create_table(cursor)
 
-def main():
-    print("Uploading index/vector table to MySQL database...")
-    connection = mysql.connector.connect(
-        host=config["HOST"],
-        port=config["PORT"],
-        user=config["USER"],
-        password=config["PASSWORD"],
-        database=config["DATABASE"]
-    )
+def migrate():
+    storage = open_storage(config)
+    connection = storage.connect()
     cursor = connection.cursor()
-    
-    # Reset the table if needed
-    reset_table(cursor)
+    if not storage.migrate_table(cursor):
+        print("webpages table already stores binary vectors...")
+    connection.commit()
+    cursor.close()
+    connection.close()
 
-    # Create the table if it doesn't already exist
-    create_table(cursor)
-    
-    # Open and read the CSV file
-    csv_path = config["DOWNLOADS_PATH"] + "/full_data.csv"
+
+def read_rows(csv_path):
     with open(csv_path, 'r', newline='', encoding='utf-8') as csvfile:
         csvreader = csv.reader(csvfile)
         # Optionally skip the header row if your CSV file has one:
@@ -68,18 +51,80 @@ def main():
             page_name = row[1].strip()
             file_path = row[2].strip()
             url = row[3].strip()
-            vector_representation = row[4].strip()  # storing as a string; you can parse it if needed
-
-            insert_query = """
-            INSERT INTO webpages (file_name, page_name, file_path, url, vector_representation)
-            VALUES (%s, %s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, (file_name, page_name, file_path, url, vector_representation))
-    
-    # Commit the changes and close the connection
-    connection.commit()
+            vector_representation = from_text(row[-1].strip())  # vector is always the last column
+            yield (file_name, page_name, file_path, url, vector_representation)
+
+
+def publish_table(storage, connection, cursor, rows):
+    # Load everything into a fresh staging table while readers keep using the live one, then swap it in
+    cursor.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+    storage.create_table(cursor, STAGING_TABLE)
+    with metrics.timer("upload.insert"):
+        inserted = storage.insert_rows(cursor, rows, STAGING_TABLE, config["UPLOAD_BATCH"])
+        connection.commit()
+    metrics.count("upload.rows", inserted)
+
+    with metrics.timer("upload.swap"):
+        storage.swap_tables(connection, cursor)
+    print(f"Published {inserted} documents...")
+
+
+def apply_changes(storage, cursor, rows, changes):
+    # Replace the rows of added or changed documents and drop removed ones, leaving the rest untouched
+    affected = set(changes["added"]) | set(changes["changed"])
+    with metrics.timer("upload.delete"):
+        storage.delete_rows(cursor, sorted(affected | set(changes["removed"])))
+    with metrics.timer("upload.insert"):
+        storage.insert_rows(cursor, (row for row in rows if row[0] in affected), batch_size=config["UPLOAD_BATCH"])
+    metrics.count("upload.rows", len(affected))
+    print(f"Upserted {len(affected)} and removed {len(changes['removed'])} documents...")
+
+
+def main():
+    with metrics.timer("upload.total"):
+        publish()
+
+
+def publish():
+    print(f"Uploading index/vector table to {config['STORAGE_BACKEND']} storage...")
+    changes = load_changes(config["DOWNLOADS_PATH"]) if config["INCREMENTAL"] else None
+    if changes is not None and not has_changes(changes):
+        print("No document changes to upload...")
+        return
+
+    storage = open_storage(config)
+    connection = storage.connect()
+    cursor = connection.cursor()
+
+    # DDL commits implicitly in MySQL, so every table exists before any rows change
+    storage.create_meta_table(cursor)
+
+    # Open and read the CSV file
+    rows = read_rows(config["DOWNLOADS_PATH"] + "/full_data.csv")
+
+    if changes is not None:
+        storage.create_table(cursor)
+        storage.migrate_table(cursor)
+
+        # Changed rows are replaced in one transaction, readers see either the old or the new rows
+        apply_changes(storage, cursor, rows, changes)
+    else:
+        publish_table(storage, connection, cursor, rows)
+
+    # Readers compare the generation to notice a new upload and reload
+    with metrics.timer("upload.commit"):
+        generation = storage.bump_generation(cursor)
+        connection.commit()
+    print(f"Index generation {generation} published...")
+
+    # Only now are the crawl's changes consumed, a failed upload leaves them for the next run
+    clear_changes(config["DOWNLOADS_PATH"])
+
     cursor.close()
     connection.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--migrate" in sys.argv:
+        migrate()
+    else:
+        main()
@@ -0,0 +1,61 @@
+import base64
+import struct
+import numpy as np
+
+# Binary vector layout: b"DV" magic, format version, a reserved byte and the uint32 dimension,
+# followed by the vector as packed little-endian float32 values. The header is exactly two
+# float32 slots wide so a run of equally sized vectors can be viewed as one matrix.
+MAGIC = b"DV"
+VERSION = 1
+HEADER = struct.Struct("<2sBxI")
+HEADER_SLOTS = HEADER.size // 4
+DTYPE = np.dtype("<f4")
+
+
+def encode_vector(vec):
+    vec = np.ascontiguousarray(vec, dtype=DTYPE).ravel()
+    return HEADER.pack(MAGIC, VERSION, len(vec)) + vec.tobytes()
+
+
+def read_header(blob):
+    magic, version, dim = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("Not a binary vector, run upload.py --migrate on legacy tables")
+    if version != VERSION:
+        raise ValueError(f"Unsupported vector format version {version}")
+    if len(blob) != HEADER.size + dim * DTYPE.itemsize:
+        raise ValueError(f"Vector blob is {len(blob)} bytes, expected {HEADER.size + dim * DTYPE.itemsize}")
+    return dim
+
+
+def decode_matrix(blobs):
+    if not blobs:
+        return np.empty((0, 0), dtype=DTYPE)
+
+    dim = read_header(blobs[0])
+    row_bytes = HEADER.size + dim * DTYPE.itemsize
+    buffer = b"".join(bytes(blob) for blob in blobs)
+    if len(buffer) != row_bytes * len(blobs):
+        raise ValueError("Vector blobs have mixed dimensions")
+
+    # Every row must carry the same header, checked in one pass over the header columns
+    headers = np.frombuffer(buffer, dtype=np.uint8).reshape(len(blobs), row_bytes)[:, :HEADER.size]
+    if not (headers == np.frombuffer(blobs[0][:HEADER.size], dtype=np.uint8)).all():
+        raise ValueError("Vector blobs have mixed headers")
+
+    return np.frombuffer(buffer, dtype=DTYPE).reshape(len(blobs), HEADER_SLOTS + dim)[:, HEADER_SLOTS:]
+
+
+def to_text(blob):
+    # CSV-safe form of a vector blob, base64 has no commas
+    return base64.b64encode(blob).decode("ascii")
+
+
+def from_text(text):
+    return base64.b64decode(text)
+
+
+def parse_legacy_vector(vector_str):
+    # Old format: json.dumps of the vector with commas swapped for semicolons
+    elements = [elem.strip() for elem in vector_str.strip()[1:-1].split(";")]
+    return np.array([float(elem) for elem in elements if elem], dtype=DTYPE)